@@ -74,6 +74,15 @@ then
 fi
 
 
+# Databases built by create_taxonomy_db.py carry a nested interval tree table,
+# which returns the whole subtree in one range scan.
+has_tree=$(sqlite3 "$names_nodes_db" "select name from sqlite_master where type='table' and name='tree'")
+if [[ $has_tree ]]
+then
+	taxonomy_tree.py descendants --taxdb "$names_nodes_db" --taxid "$taxid"
+	exit
+fi
+
 parent_to_children() {
 	children=$(sqlite3 "$names_nodes_db" "select taxid from nodes where parent_taxid=$1")
 	if [[ ! $children ]]
@@ -730,8 +730,6 @@ fi
 
 ############################# Separation into taxonomic annotated files ##############################
 
-matched_fulllength_fastq="$basef.NT.snap.matched.fulllength.fastq"
-
 #define fulllength annotated/sorted filename
 fulllength_annotated="$basef.NT.snap.matched.d${d_NT_alignment}.fl.all.annotated"
 
@@ -749,53 +747,31 @@ parasite="$basef.NT.snap.matched.d${d_NT_alignment}.fl.Parasite.annotated"
 #end of define annotated/sorted filenames
 
 
-## convert to FASTQ and retrieve full-length sequences
-echo -e "$(date)\t$scriptname\tConvert to FASTQ and retrieve full-length sequences for SNAP NT matched hits"
-echo -e "$(date)\t$scriptname\tParameters: extractHeaderFromFastq_ncores.sh $cores $cutadapted_fastq ${snap_alignment_output}.sam $matched_fulllength_fastq"
-extractHeaderFromFastq_ncores.sh "$cores" "$cutadapted_fastq" "${snap_alignment_output}.sam" "$matched_fulllength_fastq"
-sort -k1,1 "${snap_alignment_output}.sam"  > "${snap_alignment_output}.sorted.sam"
-
-cut -f1-9 "${snap_alignment_output}.sorted.sam" > "${snap_alignment_output}.sorted.sam.tmp1"
-cut -f12- "${snap_alignment_output}.sorted.sam" > "${snap_alignment_output}.sorted.sam.tmp2"
-awk '(NR%4==1) {printf("%s\t",$0)} (NR%4==2) {printf("%s\t", $0)} (NR%4==0) {printf("%s\n",$0)}' "$matched_fulllength_fastq" | sort -k1,1 | awk '{print $2 "\t" $3}' > "${snap_alignment_output}.fulllength.sequence.txt"
-
-#Verify that .tmp1, .tmp2, and .txt have same number of lines before pasting. If not, exit with an error.
-tmp1_length=$(wc -l "${snap_alignment_output}.sorted.sam.tmp1" | awk '{print $1}')
-tmp2_length=$(wc -l "${snap_alignment_output}.sorted.sam.tmp2" | awk '{print $1}')
-txt_length=$(wc -l "${snap_alignment_output}.fulllength.sequence.txt" | awk '{print $1}')
-if [[ $tmp1_length == $tmp2_length && $tmp1_length == $txt_length ]]
+## retrieve full-length sequences for SNAP NT matched hits
+echo -e "$(date)\t$scriptname\tRetrieve full-length sequences for SNAP NT matched hits"
+echo -e "$(date)\t$scriptname\tParameters: join_fulllength.py ${snap_alignment_output}.sam $cutadapted_fastq $fulllength_annotated"
+if ! join_fulllength.py "${snap_alignment_output}.sam" "$cutadapted_fastq" "$fulllength_annotated"
 then
-	echo -e "${green}files match in length (.tmp1, .tmp2, .txt).${endColor}"
-else
-	echo -e "${red}files do not match in length (.tmp1, .tmp2, .txt).${endColor}"
-	echo -e "${red}$tmp1_length\t${snap_alignment_output}.sorted.sam.tmp1${endColor}"
-	echo -e "${red}$tmp2_length\t${snap_alignment_output}.sorted.sam.tmp2${endColor}"
-	echo -e "${red}$txt_length\t${snap_alignment_output}.fulllength.sequence.txt${endColor}"
-
-	exit			
+	echo -e "${red}full-length sequences missing for reads in ${snap_alignment_output}.sam${endColor}"
+	exit
 fi
-paste "${snap_alignment_output}.sorted.sam.tmp1" "${snap_alignment_output}.fulllength.sequence.txt" "${snap_alignment_output}.sorted.sam.tmp2" > "$fulllength_annotated"
 
 ############################# Create annotated files #############################
 echo -e "$(date)\t$scriptname\tExtracting taxonomic portions from $fulllength_annotated..."
-grep	"Viruses;"			"$fulllength_annotated" 																		> "$viruses"
-grep	"Bacteria;"			"$fulllength_annotated" 																		> "$bacteria"
-grep    "Primates;"			"$fulllength_annotated" 																		> "$primates"
-grep -v "Primates"			"$fulllength_annotated" | grep "Mammalia"														> "$nonPrimMammal"
-grep -v "Mammalia"			"$fulllength_annotated" | grep "Chordata"														> "$nonMammalChordat"
-grep -v "Chordata"			"$fulllength_annotated" | grep -v "Viridiplantae" | grep "Eukaryota" | grep -v "Arthropoda;"	> "$nonChordatEuk"
-grep	"Viridiplantae;"	"$fulllength_annotated" 																		> "$plants"
-grep	"Arthropoda;"		"$fulllength_annotated"																			> "$arthropods"
-grep	"Fungi;"			"$nonChordatEuk" 																			> "$fungi"
-grep -v "Fungi;"			"$nonChordatEuk" 																			> "$parasite"
-
-#create secondary cutoff .annotated files
-grep -P 'NM:i:([0-'$d_NT_secondary_cutoff'](?!\d))' "$bacteria" > "$basef.NT.snap.matched.d${d_NT_secondary_cutoff}.fl.Bacteria.annotated"
-grep -P 'NM:i:([0-'$d_NT_secondary_cutoff'](?!\d))' "$fungi" 	> "$basef.NT.snap.matched.d${d_NT_secondary_cutoff}.fl.Fungi.annotated"
-grep -P 'NM:i:([0-'$d_NT_secondary_cutoff'](?!\d))' "$parasite" > "$basef.NT.snap.matched.d${d_NT_secondary_cutoff}.fl.Parasite.annotated"
+echo -e "$(date)\t$scriptname\tParameters: partition_annotated.py $fulllength_annotated $basef.NT.snap.matched.d${d_NT_alignment}.fl $basef.NT.snap.matched.d${d_NT_secondary_cutoff}.fl $d_NT_secondary_cutoff"
+# writes $viruses, $bacteria, $primates, $nonPrimMammal, $nonMammalChordat,
+# $nonChordatEuk, $plants, $arthropods, $fungi and $parasite plus the
+# secondary cutoff Bacteria, Fungi and Parasite .annotated files in one pass
+partition_annotated.py "$fulllength_annotated" \
+	"$basef.NT.snap.matched.d${d_NT_alignment}.fl" \
+	"$basef.NT.snap.matched.d${d_NT_secondary_cutoff}.fl" \
+	"$d_NT_secondary_cutoff"
 
 ############################# Filtering #############################
 START_FILTER=$(date +%s)
+# join_fulllength.py writes hits in SAM order; filter_SURPI_output_v1 has
+# always been given $viruses sorted by read name, so keep doing so
+sort -k1,1 -o "$viruses" "$viruses"
 filter_SURPI_output_v1 "$viruses" Viruses "$eBLASTn_filter" "$cores" "$taxonomy_db_directory" "$BLAST_folder"
 END_FILTER=$(date +%s)
 diff_FILTER=$(( END_FILTER - START_FILTER ))
@@ -846,7 +822,7 @@ counttable -ntc -tax_species "$basef.NT.snap.matched.d${d_NT_secondary_cutoff}.f
 
 readcounts_file="readcounts.$basef.BarcodeR1R2.log"
 
-summarizeReadCounts.py -r "$readcounts_file" "$basef" "$excel_template" \
+summarizeReadCounts.py --streaming --jobs "$cores" -r "$readcounts_file" "$basef" "$excel_template" \
 	"$basef.NT.snap.matched.d16.fl.Viruses.filt.NTblastn_tru.dust.annotated.species.clx.counttable" \
 	"$basef.NT.snap.matched.d16.fl.Viruses.filt.NTblastn_tru.dust.annotated.subspp.clx.counttable" \
 	"$basef.NT.snap.matched.d1.fl.Bacteria.annotated.species.clx.ntc.counttable" \
@@ -920,16 +896,11 @@ mv "$basef.cutadapt.fastq" "$trash_folder"
 mv "$basef.preprocessed.fastq" "$trash_folder"
 mv "$basef.cutadapt.cropped.dusted.bad.fastq" "$trash_folder"
 if [ -e "temp.sam" ]; then mv "temp.sam" "$trash_folder"; fi
-mv "$basef.NT.snap.matched.fulllength.fastq" "$trash_folder"
 mv "$basef.NT.snap.tax.matched.sam" "$trash_folder"
 mv "$basef.NT.snap.unmatched.sam" "$trash_folder"
-mv "$basef.NT.snap.matched.sorted.sam" "$trash_folder"
-mv "$basef.NT.snap.matched.sorted.sam.tmp2" "$trash_folder"
 if [ -e "$basef.NT.snap.unmatched.fastq" ]; then mv "$basef.NT.snap.unmatched.fastq" "$trash_folder"; fi
 if [ -e "$basef.NT.snap.matched.fastq" ]; then mv "$basef.NT.snap.matched.fastq" "$trash_folder"; fi
-mv "$basef.NT.snap.matched.sorted.sam.tmp1" "$trash_folder"
 mv "$basef.NT.snap.matched.fulllength.all.annotated" "$trash_folder"
-mv "$basef.NT.snap.matched.fulllength.sequence.txt" "$trash_folder"
 mv "$basef.NT.snap.matched.fulllength.gi.taxonomy" "$trash_folder"
 mv "$basef.NT.snap.matched.fl.Viruses.fastq" "$trash_folder"
 mv "$basef.NT.snap.matched.fl.Viruses.fasta" "$trash_folder"
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+#
+#	accession_index.py
+#
+#	Compact, memory-mappable accession to taxid index, an alternative to
+#	the acc_taxid_(nucl|prot).db SQLite lookups built by create_taxonomy_db.py.
+#	Chiu Laboratory
+#	University of California, San Francisco
+#
+# Most accessions are a short alphabetic prefix followed by digits, e.g.,
+# X17276, AB123456, AAAA01000001. Each such accession is packed into a single
+# 64-bit key:
+#
+#	prefix (up to 6 of A-Z and _, base 28)	29 bits
+#	number of digits (1-9)					 4 bits
+#	numeric part							30 bits
+#
+# so the leading zeros of the numeric part are preserved. The keys are sorted
+# and stored with their taxids as uint32. Accessions that do not fit, e.g.,
+# PDB 1ABC_A, are kept in a small sorted fixed-width overflow table.
+#
+# File layout (little-endian):
+#	header		magic, version, overflow width, key count, overflow count
+#	keys		uint64[key count]
+#	taxids		uint32[key count]
+#	padding to a multiple of 8 bytes
+#	overflow	char[overflow width][overflow count]
+#	taxids		uint32[overflow count]
+#
+# The file is read through mmap without copying, so after warming the page
+# cache, e.g., "vmtouch -t acc_taxid_nucl.idx", lookups touch only a few pages.
+#
+
+import mmap
+import re
+import struct
+import sys
+
+import numpy
+
+MAGIC = 'SURPIACC'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQQ')
+
+PREFIX_LENGTH = 6
+PREFIX_BASE = 28
+MAX_DIGITS = 9
+# longest accession that can be packed; wider strings are never packed
+WIDTH = PREFIX_LENGTH + MAX_DIGITS
+DIGIT_SHIFT = 30
+PREFIX_SHIFT = 34
+
+# powers used to place prefix characters and digits
+prefixPowers = numpy.array([PREFIX_BASE ** (PREFIX_LENGTH - 1 - i) for i in range(PREFIX_LENGTH)], dtype=numpy.uint64)
+digitPowers = numpy.array([10 ** i for i in range(MAX_DIGITS)], dtype=numpy.uint64)
+
+
+rePackable = re.compile(r'^([A-Z_]{1,%d})([0-9]{1,%d})\Z' % (PREFIX_LENGTH, MAX_DIGITS))
+# prefixCodeCache = {prefix: code}; there are few distinct prefixes
+prefixCodeCache = {}
+
+def encode(accession):
+	"""Return the key for one accession, or None if it cannot be packed.
+
+	Gives the same keys as encodeMany() without the per-call numpy overhead.
+	"""
+	m = rePackable.match(accession)
+	if m is None:
+		return None
+	prefix, digits = m.groups()
+	code = prefixCodeCache.get(prefix)
+	if code is None:
+		code = 0
+		for i in range(PREFIX_LENGTH):
+			code *= PREFIX_BASE
+			if i < len(prefix):
+				code += 27 if prefix[i] == '_' else ord(prefix[i]) - 64
+		prefixCodeCache[prefix] = code
+	return (code << PREFIX_SHIFT) | (len(digits) << DIGIT_SHIFT) | int(digits)
+
+
+def encodeMany(accessions):
+	"""Return (keys, packed) for a sequence of accessions.
+
+	packed is a boolean array; keys are only meaningful where it is true.
+	"""
+	n = len(accessions)
+	# one extra column detects accessions too long to pack
+	chars = numpy.array(accessions, dtype='S%d' % (WIDTH + 1)).view(numpy.uint8).reshape(n, WIDTH + 1)
+	lengths = (chars != 0).sum(axis=1)
+	isDigit = (chars >= 48) & (chars <= 57)
+	isUpper = (chars >= 65) & (chars <= 90)
+	isUnderscore = chars == 95
+
+	# prefix ends at the first digit
+	prefixLengths = isDigit.argmax(axis=1)
+	digitCounts = lengths - prefixLengths
+	columns = numpy.arange(WIDTH + 1)
+	inPrefix = columns < prefixLengths[:, None]
+	inNumber = ~inPrefix & (columns < lengths[:, None])
+	packed = ((prefixLengths >= 1) & (prefixLengths <= PREFIX_LENGTH)
+			& (digitCounts >= 1) & (digitCounts <= MAX_DIGITS)
+			& ((isUpper | isUnderscore) | ~inPrefix).all(axis=1)
+			& (isDigit | ~inNumber).all(axis=1))
+
+	# A-Z -> 1-26, _ -> 27, padding -> 0
+	letters = chars[:, :PREFIX_LENGTH].astype(numpy.uint64)
+	codes = numpy.where(isUnderscore[:, :PREFIX_LENGTH], 27, letters - 64)
+	codes = numpy.where(inPrefix[:, :PREFIX_LENGTH], codes, 0).astype(numpy.uint64)
+	prefixCodes = (codes * prefixPowers).sum(axis=1, dtype=numpy.uint64)
+
+	# place value of each digit from the right-hand end of the accession
+	exponents = lengths[:, None] - 1 - columns
+	exponents = numpy.clip(exponents, 0, MAX_DIGITS - 1)
+	digits = numpy.where(inNumber, chars.astype(numpy.uint64) - 48, 0).astype(numpy.uint64)
+	numbers = (digits * digitPowers[exponents]).sum(axis=1, dtype=numpy.uint64)
+
+	keys = ((prefixCodes << numpy.uint64(PREFIX_SHIFT))
+			| (digitCounts.astype(numpy.uint64) << numpy.uint64(DIGIT_SHIFT))
+			| numbers)
+	return numpy.where(packed, keys, 0).astype(numpy.uint64), packed
+
+
+class IndexWriter(object):
+	"""Accumulate (accession, taxid) rows and write a sorted index file."""
+
+	def __init__(self):
+		self.keyChunks = []
+		self.taxidChunks = []
+		self.overflow = []
+
+	def addMany(self, rows):
+		"""Add a chunk of (accession, taxid) rows."""
+		if not rows:
+			return
+		accessions = [row[0] for row in rows]
+		taxids = numpy.array([int(row[1]) for row in rows], dtype=numpy.uint32)
+		keys, packed = encodeMany(accessions)
+		self.keyChunks.append(keys[packed])
+		self.taxidChunks.append(taxids[packed])
+		for i in numpy.flatnonzero(~packed):
+			self.overflow.append((accessions[i], taxids[i]))
+
+	def write(self, fileName):
+		keys = numpy.concatenate(self.keyChunks) if self.keyChunks else numpy.zeros(0, dtype=numpy.uint64)
+		taxids = numpy.concatenate(self.taxidChunks) if self.taxidChunks else numpy.zeros(0, dtype=numpy.uint32)
+		order = keys.argsort(kind='mergesort')
+		keys = keys[order]
+		taxids = taxids[order]
+
+		self.overflow.sort()
+		width = max([len(acc) for acc, taxid in self.overflow] or [1])
+		overflowKeys = numpy.array([acc for acc, taxid in self.overflow], dtype='S%d' % width)
+		overflowTaxids = numpy.array([taxid for acc, taxid in self.overflow], dtype=numpy.uint32)
+
+		with open(fileName, 'wb') as f:
+			f.write(HEADER.pack(MAGIC, VERSION, width, len(keys), len(overflowKeys)))
+			f.write(keys.astype('<u8').tostring())
+			f.write(taxids.astype('<u4').tostring())
+			f.write('\0' * (-f.tell() % 8))
+			f.write(overflowKeys.tostring())
+			f.write(overflowTaxids.astype('<u4').tostring())
+		return len(keys), len(overflowKeys)
+
+
+class AccessionIndex(object):
+	"""Read-only, zero-copy view of an index file written by IndexWriter."""
+
+	def __init__(self, fileName):
+		with open(fileName, 'rb') as f:
+			self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, version, width, keyCount, overflowCount = HEADER.unpack_from(self.mm, 0)
+		if magic != MAGIC or version != VERSION:
+			raise ValueError("%s is not an accession index" % fileName)
+
+		offset = HEADER.size
+		self.keys = numpy.frombuffer(self.mm, dtype='<u8', count=keyCount, offset=offset)
+		offset += 8 * keyCount
+		self.taxids = numpy.frombuffer(self.mm, dtype='<u4', count=keyCount, offset=offset)
+		offset += 4 * keyCount
+		offset += -offset % 8
+		self.width = width
+		self.overflowKeys = numpy.frombuffer(self.mm, dtype='S%d' % width, count=overflowCount, offset=offset)
+		offset += width * overflowCount
+		self.overflowTaxids = numpy.frombuffer(self.mm, dtype='<u4', count=overflowCount, offset=offset)
+
+	def __len__(self):
+		return len(self.keys) + len(self.overflowKeys)
+
+	def lookup(self, accession):
+		"""Return the taxid for one accession, or None if not found."""
+		taxid = self.lookupMany([accession])[0]
+		if not taxid:
+			return None
+		return int(taxid)
+
+	def lookupMany(self, accessions):
+		"""Return a uint32 array of taxids, 0 where an accession is not found."""
+		result = numpy.zeros(len(accessions), dtype=numpy.uint32)
+		if not len(accessions):
+			return result
+
+		keys, packed = encodeMany(accessions)
+		if len(self.keys):
+			where = numpy.flatnonzero(packed)
+			found = _search(self.keys, keys[where])
+			result[where[found >= 0]] = self.taxids[found[found >= 0]]
+
+		unpacked = numpy.flatnonzero(~packed)
+		if len(unpacked) and len(self.overflowKeys):
+			queries = [accessions[i] for i in unpacked]
+			# anything wider than the overflow table cannot be in it
+			fits = numpy.array([len(acc) <= self.width for acc in queries])
+			found = _search(self.overflowKeys, numpy.array(queries, dtype='S%d' % self.width))
+			found[~fits] = -1
+			result[unpacked[found >= 0]] = self.overflowTaxids[found[found >= 0]]
+		return result
+
+	def close(self):
+		self.keys = self.taxids = self.overflowKeys = self.overflowTaxids = None
+		self.mm.close()
+
+
+def _search(sortedKeys, queries):
+	"""Return the position of each query in sortedKeys, -1 where absent."""
+	positions = sortedKeys.searchsorted(queries)
+	positions[positions >= len(sortedKeys)] = 0
+	found = sortedKeys[positions] == queries
+	return numpy.where(found, positions, -1)
+
+
+#
+### Command line
+#
+
+BATCH_SIZE = 1000000
+
+def usage(msg=None):
+	print "Usage: %s <index file> [<accession file>]" % sys.argv[0]
+	print "  Look up the taxid of each accession, one per line (default: standard input),"
+	print "  and print 'accession<tab>taxid'; unknown accessions print taxid 0."
+	print "  Version suffixes, e.g., .1, are ignored."
+	if msg is not None:
+		print msg
+
+
+def main(indexFile, f):
+	index = AccessionIndex(indexFile)
+	batch = []
+	for line in f:
+		acc = line.split()[0].split('.')[0] if line.strip() else ''
+		if not acc:
+			continue
+		batch.append(acc)
+		if len(batch) == BATCH_SIZE:
+			writeBatch(index, batch)
+			batch = []
+	writeBatch(index, batch)
+
+
+def writeBatch(index, batch):
+	if not batch:
+		return
+	taxids = index.lookupMany(batch)
+	sys.stdout.write(''.join(["%s\t%d\n" % row for row in zip(batch, taxids)]))
+
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
+		usage()
+		sys.exit(2)
+
+	if len(sys.argv) > 2:
+		with open(sys.argv[2], 'rU') as f:
+			main(sys.argv[1], f)
+	else:
+		main(sys.argv[1], sys.stdin)
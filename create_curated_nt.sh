@@ -21,8 +21,8 @@ normal=$(tput sgr0)
 # Unclassified
 
 # This script will remove the taxid corresponding to the names in the names_list array
-# Using this taxid list, it then looks up all the Genbank identifiers contained within the taxid & places them into $gb_to_remove
-# Finally, it removes all the Genbank identifier from the FASTA file given (should be an nt file)
+# Using this taxid list, the FASTA filter looks up all the Genbank identifiers contained within the taxid
+# in one query and removes them from the FASTA file given (should be an nt file)
 
 optspec=":ghi:q:"
 while getopts "$optspec" option; do
@@ -95,10 +95,8 @@ name_to_taxid() {
 	done
 }
 taxid_to_remove="taxid_to_remove.taxid"
-gb_to_remove="gb_to_remove.gb"
 
 > $taxid_to_remove
-> $gb_to_remove
 
 declare -a names_list=(	"other sequences" \
 						"uncultured" \
@@ -126,22 +124,15 @@ do
 	awk -F\| '{print $1}' "${taxid_to_remove}.full" >> "$taxid_to_remove"
 done
 sort -nu "$taxid_to_remove" > "$taxid_to_remove.uniq"
-if [[ ${GI} -eq 1 ]]; then
-	NCBI_taxid_to_gb.pl -g -i "$taxid_to_remove.uniq" -d nucl -q "$taxonomy_folder" >> "$gb_to_remove"
-else
-	NCBI_taxid_to_gb.pl -i "$taxid_to_remove.uniq" -d nucl -q "$taxonomy_folder" >> "$gb_to_remove"
-fi
 
 taxid_count=$(wc -l "$taxid_to_remove.uniq")
-gb_count=$(wc -l "$gb_to_remove")
 
 echo -e "$(date)\t$scriptname\tTaxonomic Restriction"
 echo -e "$(date)\t$scriptname\ttaxid removed: $taxid_count"
-echo -e "$(date)\t$scriptname\tgb removed: $gb_count"
 
-END_gb_list_creation=$(date +%s)
-diff_gb_list_creation=$(( END_gb_list_creation - START_creation ))
-echo -e "$(date)\t$scriptname\tTaxonomic gb list creation took $diff_gb_list_creation seconds"
+END_taxid_list_creation=$(date +%s)
+diff_taxid_list_creation=$(( END_taxid_list_creation - START_creation ))
+echo -e "$(date)\t$scriptname\tTaxonomic taxid list creation took $diff_taxid_list_creation seconds"
 
 # for GI want bare number and description
 # accession-only fastas already have format
@@ -161,16 +152,17 @@ fi
 
 #Now, do removal & create new FASTA file
 #	$nt_FASTA: input FASTA
-#	$gb_to_remove: gb list to remove
-#	$output_FASTA = ($nt_FASTA - $gb_to_remove)
-#	$sequences_removed = (FASTA of $gb_to_remove)
+#	gb to remove: gb of the taxid in $taxid_to_remove.uniq, looked up by the filter
+#	$output_FASTA = ($nt_FASTA - gb to remove)
+#	$sequences_removed = (FASTA of gb to remove)
 #	i.e. $nt_FASTA = ($output_FASTA + $sequences_removed)
 START_tax_restriction=$(date +%s)
+total_cores=$(grep processor /proc/cpuinfo | wc -l)
 
 if [[ ${GI} -eq 1 ]]; then
-	remove_gi_from_fasta.py "${nt_FASTA}.reducedheaders" "$gb_to_remove" "$output_FASTA" "$sequences_removed"
+	remove_gi_from_fasta.py --workers "$total_cores" --taxdb "$taxonomy_folder/gi_taxid_nucl.db" "${nt_FASTA}.reducedheaders" "$taxid_to_remove.uniq" "$output_FASTA" "$sequences_removed"
 else
-	remove_acc_from_fasta.py "${nt_FASTA}" "$gb_to_remove" "$output_FASTA" "$sequences_removed"
+	remove_acc_from_fasta.py --workers "$total_cores" --taxdb "$taxonomy_folder/acc_taxid_nucl.db" "${nt_FASTA}" "$taxid_to_remove.uniq" "$output_FASTA" "$sequences_removed"
 fi
 
 END_tax_restriction=$(date +%s)
@@ -10,8 +10,17 @@
 # SURPI has been released under a modified BSD license.
 # Please see license file for details.
 
+import itertools
+import multiprocessing
+import os
 import sqlite3
 import sys
+import time
+
+import tagTaxonomy
+
+# rows per executemany batch; each batch is committed as one transaction
+chunkSize = 500000
 
 def create_names_nodes():
 	print ("Creating names_nodes_scientific.db...")
@@ -23,35 +32,149 @@ def create_names_nodes():
 	c.execute('''CREATE TABLE names (
 				taxid INTEGER PRIMARY KEY,
 				name TEXT)''')
-	c.execute("CREATE INDEX IF NOT EXISTS nameIdx ON names (name)")
-
-	with open('names_scientificname.dmp', 'rU') as f:
-		for line in f:
-			line = line.split("|")
-			taxid = line[0].strip()
-			name = line[1].strip()
-			c.execute("INSERT INTO names VALUES (?,?)", (taxid, name))
+	bulkInsert(conn, c, 'names', 2, readNames('names_scientificname.dmp'), 'names_scientificname.dmp')
 
 	c.execute('''CREATE TABLE nodes (
 				taxid INTEGER PRIMARY KEY,
 				parent_taxid INTEGER, 
 				rank TEXT,
 				division_id INTEGER)''')
-	c.execute("CREATE INDEX IF NOT EXISTS rankIdx ON nodes (rank)")
-	c.execute("CREATE INDEX IF NOT EXISTS dividIdx ON nodes (division_id)")
-	c.execute("CREATE INDEX IF NOT EXISTS parentIdx ON nodes (parent_taxid)")
+	bulkInsert(conn, c, 'nodes', 4, readNodes('nodes.dmp'), 'nodes.dmp')
 
-	with open('nodes.dmp', 'rU') as f:
+	c.execute('''CREATE TABLE lookup (
+				taxid INTEGER PRIMARY KEY,
+				name TEXT,
+				rank TEXT,
+				%s,
+				lineage TEXT,
+				taxid_lineage TEXT)''' % ', '.join(['"%s" TEXT' % rank for rank in LINEAGE_RANKS]))
+	tree = TaxonomyTree('nodes.dmp', 'names_scientificname.dmp')
+	bulkInsert(conn, c, 'lookup', 5 + len(LINEAGE_RANKS), tree.lookupRows(), 'nodes.dmp')
+
+	# nested interval numbering, see TaxonomyTree.intervals()
+	c.execute('''CREATE TABLE tree (
+				taxid INTEGER PRIMARY KEY,
+				pre INTEGER,
+				post INTEGER,
+				depth INTEGER)''')
+	bulkInsert(conn, c, 'tree', 4, tree.intervals(), 'nodes.dmp')
+
+	createIndexes(conn, c, [
+		"CREATE INDEX IF NOT EXISTS nameIdx ON names (name)",
+		"CREATE INDEX IF NOT EXISTS rankIdx ON nodes (rank)",
+		"CREATE INDEX IF NOT EXISTS dividIdx ON nodes (division_id)",
+		"CREATE INDEX IF NOT EXISTS parentIdx ON nodes (parent_taxid)",
+		"CREATE INDEX IF NOT EXISTS lookupFamilyIdx ON lookup (family)",
+		"CREATE INDEX IF NOT EXISTS lookupGenusIdx ON lookup (genus)",
+		"CREATE INDEX IF NOT EXISTS lookupSpeciesIdx ON lookup (species)",
+		"CREATE UNIQUE INDEX IF NOT EXISTS treePreIdx ON tree (pre)",
+	])
+	# the full-text index over lookup searched by tagTaxonomy.py is rebuilt with it
+	tagTaxonomy.createSearchIndex(conn)
+
+	conn.commit()
+	conn.close()
+
+def readNames(fName):
+	with open(fName, 'rU') as f:
+		for line in f:
+			line = line.split("|")
+			taxid = line[0].strip()
+			name = line[1].strip()
+			yield taxid, name
+
+def readNodes(fName):
+	with open(fName, 'rU') as f:
 		for line in f:
 			line = line.split("|")
 			taxid = line[0].strip()
 			parent_taxid = line[1].strip()
 			rank = line[2].strip()
 			div_id = line[4].strip()
-			c.execute ("INSERT INTO nodes VALUES (?,?,?,?)", (taxid, parent_taxid, rank, div_id))
+			yield taxid, parent_taxid, rank, div_id
+
+
+# canonical ranks given their own column in the lookup table, root first
+LINEAGE_RANKS = ['superkingdom', 'kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+ROOT = 1
+
+class TaxonomyTree(object):
+	"""The NCBI taxonomy held in memory for computing lineages in one pass."""
+
+	def __init__(self, nodesFile, namesFile):
+		self.names = {}
+		for taxid, name in readNames(namesFile):
+			self.names[int(taxid)] = name
+		self.ranks = {}
+		self.children = {}
+		for taxid, parent_taxid, rank, div_id in readNodes(nodesFile):
+			taxid = int(taxid)
+			parent_taxid = int(parent_taxid)
+			self.ranks[taxid] = rank
+			# root is its own parent
+			if taxid != parent_taxid:
+				self.children.setdefault(parent_taxid, []).append(taxid)
+
+	def walk(self):
+		"""Yield (taxid, names, taxids, rank columns) for every node, depth first from root.
+
+		names and taxids are the lineage below root down to and including the node.
+		"""
+		rankIndex = dict((rank, i) for i, rank in enumerate(LINEAGE_RANKS))
+		emptyRanks = ('',) * len(LINEAGE_RANKS)
+		stack = [(ROOT, (), (), emptyRanks)]
+		while stack:
+			taxid, names, taxids, rankColumns = stack.pop()
+			if taxid != ROOT:
+				name = self.names.get(taxid, '')
+				names = names + (name,)
+				taxids = taxids + (taxid,)
+				i = rankIndex.get(self.ranks[taxid])
+				if i is not None:
+					rankColumns = rankColumns[:i] + (name,) + rankColumns[i+1:]
+			yield taxid, names, taxids, rankColumns
+			for child in reversed(self.children.get(taxid, ())):
+				stack.append((child, names, taxids, rankColumns))
+
+	def lookupRows(self):
+		"""Yield the lookup table rows.
+
+		lineage and taxid_lineage list each taxon below root followed by ';',
+		matching the lineage reported by taxonomy_lookup_embedded.pl.
+		"""
+		count = 0
+		for taxid, names, taxids, rankColumns in self.walk():
+			count += 1
+			lineage = ''.join(['%s;' % name for name in names])
+			taxidLineage = ''.join(['%d;' % t for t in taxids])
+			yield (taxid, self.names.get(taxid, ''), self.ranks[taxid]) + rankColumns + (lineage, taxidLineage)
+		if count != len(self.ranks):
+			print ("  %d nodes not connected to root were left out of lookup" % (len(self.ranks) - count,))
+
+	def intervals(self):
+		"""Yield (taxid, pre, post, depth) for every node, in post order.
+
+		One counter numbers each node on entry (pre) and on exit (post) of a
+		depth first traversal, so the descendants of a node are exactly the
+		nodes with pre between its pre and post, and X is under Y when
+		Y.pre < X.pre < Y.post.
+		"""
+		counter = 0
+		# pre numbers of the nodes on the current path
+		pre = {}
+		stack = [(ROOT, 0, False)]
+		while stack:
+			taxid, depth, exiting = stack.pop()
+			if exiting:
+				yield taxid, pre.pop(taxid), counter, depth
+				counter += 1
+				continue
 
-	conn.commit()
-	conn.close()
+			pre[taxid] = counter
+			counter += 1
+			stack.append((taxid, depth, True))
+			for child in reversed(self.children.get(taxid, ())):
+				stack.append((child, depth + 1, False))
 
 
 def createGILookup():
@@ -61,46 +184,59 @@ def createGILookup():
 	c.execute('''CREATE TABLE gi_taxid (
 				gi INTEGER PRIMARY KEY,
 				taxid INTEGER)''')
-	c.execute("CREATE INDEX tax_index ON gi_taxid (taxid);")
-	insertGI(c, 'gi_taxid_nucl.dmp')
+	insertGI(conn, c, 'gi_taxid_nucl.dmp')
+	createIndexes(conn, c, ["CREATE INDEX tax_index ON gi_taxid (taxid);"])
 
 	conn.commit()
 	conn.close()
 
-def insertGI(cursor, fName):
+def insertGI(conn, cursor, fName):
+	bulkInsert(conn, cursor, 'gi_taxid', 2, readGI(fName), fName)
+
+def readGI(fName):
+	remapped = 0
 	with open(fName, 'rU') as f:
 		for line in f:
 			line = line.split()
-			cursor.execute("INSERT INTO gi_taxid VALUES (?,?)", (line[0], line[1]))
-
-
-def createAccessionLookup():
-	print ("Creating acc_taxid_nucl.db...")
-	conn, c = connect('acc_taxid_nucl.db')
+			taxid = mergedTaxids.get(line[1])
+			if taxid is None:
+				taxid = line[1]
+			else:
+				remapped += 1
+			yield line[0], taxid
+	logMerged(fName, remapped)
+
+
+def createAccessionLookup(dbName, fName):
+	print ("Creating %s..." % dbName)
+	conn, c = connect(dbName)
+	writer = None
+	if binary:
+		# numpy is only required for the binary index
+		import accession_index
+		writer = accession_index.IndexWriter()
 
 	c.execute('''CREATE TABLE acc_taxid (
-				acc TEXT PRIMARY KEY,
+				acc TEXT PRIMARY KEY, 
 				taxid INTEGER)''')
-	c.execute ("CREATE INDEX tax_index ON acc_taxid (taxid);")
-	insertAccession(c, 'nucl_gb.accession2taxid')
+	insertAccession(conn, c, fName, writer)
+	createIndexes(conn, c, ["CREATE INDEX tax_index ON acc_taxid (taxid);"])
 
 	conn.commit()
 	conn.close()
 
-	print ("Creating acc_taxid_prot.db...")
-	conn, c = connect('acc_taxid_prot.db')
-
-	c.execute('''CREATE TABLE acc_taxid (
-				acc TEXT PRIMARY KEY, 
-				taxid INTEGER)''')
-	c.execute ("CREATE INDEX tax_index ON acc_taxid (taxid);")
-	insertAccession(c, 'prot.accession2taxid')
+	if writer is not None:
+		indexName = dbName.replace('.db', '.idx')
+		start = time.time()
+		keyCount, overflowCount = writer.write(indexName)
+		print ("  %s: %d packed and %d overflow accessions written in %.1f s" % (indexName, keyCount, overflowCount, time.time() - start))
 
-	conn.commit()
-	conn.close()
+def insertAccession(conn, cursor, fName, writer=None):
+	bulkInsert(conn, cursor, 'acc_taxid', 2, readAccession(fName), fName, writer)
 
-def insertAccession(cursor, fName):
+def readAccession(fName):
 	heading = True
+	remapped = 0
 	with open(fName, 'rU') as f:
 		for line in f:
 			line = line.split()
@@ -108,20 +244,62 @@ def insertAccession(cursor, fName):
 				assert line[0] == 'accession'
 				heading = False
 				continue
-			cursor.execute("INSERT INTO acc_taxid VALUES (?,?)", (line[0], line[2]))
-
-
-def mergeTaxids(ref):
-	print ("Merging tax IDs...")
-	conn, c = connect('%s_taxid_nucl.db' % ref)
-
-	with open('merged.dmp', 'rU') as f:
+			taxid = mergedTaxids.get(line[2])
+			if taxid is None:
+				taxid = line[2]
+			else:
+				remapped += 1
+			yield line[0], taxid
+	logMerged(fName, remapped)
+
+
+# Old taxids listed in merged.dmp are replaced by their new taxid while the
+# lookup rows stream in, so no row is rewritten after loading.
+# mergedTaxids = {old taxid: new taxid}
+mergedTaxids = {}
+def readMerged(fName):
+	print ("Reading merged tax IDs from %s..." % fName)
+	merged = {}
+	with open(fName, 'rU') as f:
 		for line in f:
 			line = line.split()
-			c.execute("UPDATE %s_taxid SET taxid = ? WHERE taxid = ?" % ref, (line[2], line[0]))
-
+			merged[line[0]] = line[2]
+	return merged
+
+def logMerged(fName, remapped):
+	if mergedTaxids:
+		print ("  %s: %d merged tax IDs replaced" % (fName, remapped))
+
+
+# Loading row by row with secondary indexes already in place costs a B-tree
+# update per index per row, so rows are inserted in large executemany batches
+# and the indexes are built once the table is fully loaded.
+def bulkInsert(conn, cursor, table, ncols, rows, source, writer=None):
+	sql = "INSERT INTO %s VALUES (%s)" % (table, ','.join('?' * ncols))
+	count = 0
+	start = time.time()
+	while True:
+		chunk = list(itertools.islice(rows, chunkSize))
+		if not chunk:
+			break
+		cursor.executemany(sql, chunk)
+		conn.commit()
+		if writer is not None:
+			writer.addMany(chunk)
+		count += len(chunk)
+	logRate('%s from %s' % (table, source), count, time.time() - start)
+	return count
+
+def createIndexes(conn, cursor, statements):
+	start = time.time()
+	for statement in statements:
+		cursor.execute(statement)
 	conn.commit()
-	conn.close()
+	print ("  indexes built in %.1f s" % (time.time() - start,))
+
+def logRate(table, count, elapsed):
+	rate = count / elapsed if elapsed > 0 else 0
+	print ("  %s: %d rows in %.1f s (%d rows/s)" % (table, count, elapsed, rate))
 
 # A crash or power failure could corrupt the database but that is
 # small risk compared to the improved throughput.
@@ -131,18 +309,56 @@ def connect(dbName):
 	c.execute("PRAGMA synchronous=OFF")
 	c.execute("PRAGMA journal_mode=OFF")
 	c.execute("PRAGMA locking_mode=EXCLUSIVE")
+	# large page cache keeps the primary key B-tree hot during bulk loads
+	c.execute("PRAGMA cache_size=-1048576")
 	return conn, c
 
+# The databases are independent SQLite files, so each can be built in its
+# own process.
+def build(target):
+	start = time.time()
+	if target == 'names':
+		create_names_nodes()
+	elif target == 'gi_nucl':
+		createGILookup()
+	elif target == 'acc_nucl':
+		createAccessionLookup('acc_taxid_nucl.db', 'nucl_gb.accession2taxid')
+	elif target == 'acc_prot':
+		createAccessionLookup('acc_taxid_prot.db', 'prot.accession2taxid')
+	print ("Completed %s in %.1f s" % (target, time.time() - start))
+
+# source files, used to start the largest builds first
+targetSources = {
+	'names': 'nodes.dmp',
+	'gi_nucl': 'gi_taxid_nucl.dmp',
+	'acc_nucl': 'nucl_gb.accession2taxid',
+	'acc_prot': 'prot.accession2taxid',
+}
+
 def main():
-	create_names_nodes()
+	global mergedTaxids
+	if merge:
+		# read before forking so every build process shares the mapping
+		mergedTaxids = readMerged('merged.dmp')
+
 	if GI:
-		ref = 'gi'
-		createGILookup()
+		targets = ['names', 'gi_nucl']
 	else:
-		ref = 'acc'
-		createAccessionLookup()
-	if merge:
-		mergeTaxids(ref)
+		targets = ['names', 'acc_nucl', 'acc_prot']
+
+	if jobs <= 1:
+		for target in targets:
+			build(target)
+		return
+
+	targets.sort(key=lambda target: os.path.getsize(targetSources[target]), reverse=True)
+	pool = multiprocessing.Pool(min(jobs, len(targets)))
+	results = [pool.apply_async(build, (target,)) for target in targets]
+	pool.close()
+	# get() re-raises any exception from the worker
+	for result in results:
+		result.get()
+	pool.join()
 
 
 def version():
@@ -153,8 +369,12 @@ def version():
 def usage(msg=None):
 	print "Create the SQLite taxonomy databases used by SURPI."
 	print
-	print "Usage: %s [--version] [--gi]" % sys.argv[0]
+	print "Usage: %s [--version] [--gi] [--merge] [--chunksize=<rows>] [--jobs=<processes>] [--binary]" % sys.argv[0]
 	print "  --gi: create GI-based mappings to taxid (default: use accession)"
+	print "  --merge: replace old taxids listed in merged.dmp while loading the lookup databases"
+	print "  --chunksize: rows inserted per batch and transaction (default: %d)" % chunkSize
+	print "  --jobs: number of databases to build in parallel processes (default: 1)"
+	print "  --binary: also write memory-mappable acc_taxid_(nucl|prot).idx files (see accession_index.py)"
 	print "Pre-populates the clinical analysis report with SURPI data."
 	if msg is not None:
 		print msg
@@ -163,13 +383,21 @@ if __name__ == '__main__':
 	import getopt
 	GI = False
 	merge = False
-	options, args = getopt.getopt(sys.argv[1:], "", ['gi', 'merge', 'version'])
+	jobs = 1
+	binary = False
+	options, args = getopt.getopt(sys.argv[1:], "", ['gi', 'merge', 'chunksize=', 'jobs=', 'binary', 'version'])
 	try:
 		for option, value in options:
 			if option == '--gi':
 				GI = True
 			elif option == '--merge':
 				merge = True
+			elif option == '--chunksize':
+				chunkSize = int(value)
+			elif option == '--jobs':
+				jobs = int(value)
+			elif option == '--binary':
+				binary = True
 			elif option == '--version':
 				version()
 				sys.exit()
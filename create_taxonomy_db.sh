@@ -17,11 +17,12 @@ scriptname=${0##*/}
 # FIXME remove hard-coding; how to specify?
 tag_db_file="/usr/local/bin/surpi-dev/tagging_list_5.txt"
 
-while getopts ":d:ghm:" option; do
+while getopts ":d:ghj:m:" option; do
 	case "${option}" in
 		d) db_directory=${OPTARG};;
 		g) GI=1;;
 		h) HELP=1;;
+		j) JOBS=${OPTARG};;
 		m) MERGED=${OPTARG};;
 		:)	echo "Option -$OPTARG requires an argument." >&2
 			exit 1
@@ -45,6 +46,8 @@ ${bold}Command Line Switches:${normal}
 
 	-d	Specify directory containing NCBI data
 
+	-j	Specify number of databases to build in parallel (default: 3)
+
 	-m	Specify whether to adjust taxid using merged.dmp [T (default)/F]
 			This step will use the merged.dmp file (from NCBI taxonomy). This file lists old taxids and
 		their new taxid.
@@ -55,6 +58,11 @@ USAGE
 	exit
 fi
 
+if [[ -z $JOBS ]]
+then
+	JOBS=3
+fi
+
 if [[ -z $MERGED ]]
 then
 	MERGED="T"
@@ -90,9 +98,9 @@ if [[ ${GI} -eq 1 ]]; then
 	echo -e "$(date)\t$scriptname\tStarting creation of taxonomy SQLite databases..."
 	if [[ $MERGED == "T" ]]
 	then
-		create_taxonomy_db.py --gi --merge
+		create_taxonomy_db.py --gi --merge --jobs "$JOBS"
 	else
-		create_taxonomy_db.py --gi
+		create_taxonomy_db.py --gi --jobs "$JOBS"
 	fi
 else
 	# ACCESSIONS
@@ -117,9 +125,9 @@ else
 	echo -e "$(date)\t$scriptname\tStarting creation of taxonomy SQLite databases..."
 	if [[ $MERGED == "T" ]]
 	then
-		create_taxonomy_db.py --merge
+		create_taxonomy_db.py --merge --jobs "$JOBS"
 	else
-		create_taxonomy_db.py
+		create_taxonomy_db.py --jobs "$JOBS"
 	fi
 fi
 
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+#	extract_fastq.py
+#
+#	Retrieve the FASTQ records named in a header list or SAM file from a
+#	large parent FASTQ file, using several processes.
+#	Chiu Laboratory
+#	University of California, San Francisco
+#
+# The parent file is memory-mapped and divided into record-aligned byte
+# ranges (see fastq_shards.py), so nothing is split or copied on disk. The
+# wanted names are read once before the workers are forked, so every worker
+# shares the same set. The ranges are processed in order and their records
+# written as they come back, so the output is in parent file order, as with
+# fqextract.
+#
+# A record is wanted if its header line, less the '@', is exactly one of the
+# names, as in fqextract. Names are the first word of each line of the query
+# file, i.e., the read name of a SAM file.
+#
+# This replaces extractHeaderFromFastq_ncores.sh, which was removed once
+# SURPI.sh joined SNAP hits with their full-length reads in join_fulllength.py.
+#
+
+import getopt
+import itertools
+import multiprocessing
+import sys
+import time
+
+import fastq_shards
+
+BUFFER_SIZE = 16 * 1024 * 1024
+# ranges are kept small enough that each worker's output is modest
+RANGE_SIZE = 64 * 1024 * 1024
+
+def readNames(queryFile):
+	"""Return the set of first words of the lines of queryFile."""
+	names = set()
+	with open(queryFile, 'rb', BUFFER_SIZE) as f:
+		for line in f:
+			words = line.split(None, 1)
+			if words:
+				names.add(words[0])
+	return names
+
+# set in the main process before the workers are forked
+wanted = None
+parentFile = None
+
+def extractRange(args):
+	"""Return the number of wanted records in a byte range of the parent file and their bytes."""
+	start, end = args
+	fastq = fastq_shards.mapFile(parentFile)
+	fastq.seek(start)
+	readline = fastq.readline
+	records = []
+	while fastq.tell() < end:
+		header = readline()
+		if header[1:].rstrip('\n') in wanted:
+			records.append(header + readline() + readline() + readline())
+		else:
+			readline(); readline(); readline()
+	fastq.close()
+	return len(records), ''.join(records)
+
+def extract(queryFile, fastqFile, outputFile, workers=1):
+	"""Write the records of fastqFile named in queryFile to outputFile; return the number written."""
+	global wanted, parentFile
+	wanted = readNames(queryFile)
+	parentFile = fastqFile
+	count = 0
+	with open(outputFile, 'wb', BUFFER_SIZE) as out:
+		fastq = fastq_shards.mapFile(fastqFile)
+		if fastq is None:
+			return count
+		ranges = fastq_shards.shardOffsets(fastq, max(workers * 4, len(fastq) // RANGE_SIZE))
+		fastq.close()
+
+		pool = None
+		if workers > 1 and len(ranges) > 1:
+			pool = multiprocessing.Pool(min(workers, len(ranges)))
+			results = pool.imap(extractRange, ranges)
+		else:
+			results = itertools.imap(extractRange, ranges)
+		for records, data in results:
+			out.write(data)
+			count += records
+		if pool is not None:
+			pool.close()
+			pool.join()
+	return count
+
+
+def usage():
+	print "Usage: %s [--workers <N>] <query file (SAM or header list)> <parent file (FASTQ)> <output file (FASTQ)>" % sys.argv[0]
+	print "  --workers: number of processes (default: 1)"
+
+if __name__ == '__main__':
+	options, args = getopt.getopt(sys.argv[1:], "", ['workers='])
+	workers = 1
+	for option, value in options:
+		if option == '--workers':
+			workers = int(value)
+
+	if len(args) != 3:
+		usage()
+		sys.exit(2)
+
+	start = time.time()
+	count = extract(args[0], args[1], args[2], workers)
+	print "# %d records written to %s in %.1f s" % (count, args[2], time.time() - start)
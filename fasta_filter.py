@@ -0,0 +1,336 @@
+#
+#	fasta_filter.py
+#
+#	Shared code for remove_acc_from_fasta.py and remove_gi_from_fasta.py:
+#	build the set of identifiers to remove and split a FASTA file into
+#	retained and removed sequences.
+#	Chiu Laboratory
+#	University of California, San Francisco
+#
+
+import collections
+import itertools
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import sys
+import time
+
+import numpy
+
+import accession_index
+
+
+# A Python set of str costs roughly 80-100 bytes per identifier, i.e., many GB
+# for tens of millions of accessions. Removal sets are instead kept as sorted
+# numpy arrays of 8-byte keys (accessions packed as in accession_index.py,
+# GIs as integers) and searched by binary search. The arrays hold no Python
+# objects, so forked shard workers share them without copying pages.
+CHUNK_SIZE = 1000000
+
+class AccessionSet(object):
+	"""Compact set of accessions."""
+
+	def __init__(self):
+		self.keyChunks = []
+		self.keys = numpy.zeros(0, dtype=numpy.uint64)
+		# accessions that cannot be packed, e.g., PDB 1ABC_A
+		self.overflow = set()
+
+	def update(self, accessions):
+		for chunk in chunks(accessions):
+			keys, packed = accession_index.encodeMany(chunk)
+			self.keyChunks.append(keys[packed])
+			self.overflow.update([chunk[i] for i in numpy.flatnonzero(~packed)])
+		return self
+
+	def freeze(self):
+		self.keys = numpy.unique(numpy.concatenate([self.keys] + self.keyChunks))
+		self.keyChunks = []
+		return self
+
+	def __contains__(self, accession):
+		key = accession_index.encode(accession)
+		if key is None:
+			return accession in self.overflow
+		return _contains(self.keys, key)
+
+	def __len__(self):
+		return len(self.keys) + len(self.overflow)
+
+	def nbytes(self):
+		return self.keys.nbytes + sys.getsizeof(self.overflow) + sum([sys.getsizeof(acc) for acc in self.overflow])
+
+
+class GISet(object):
+	"""Compact set of GI numbers."""
+
+	def __init__(self):
+		self.keyChunks = []
+		self.keys = numpy.zeros(0, dtype=numpy.uint64)
+
+	def update(self, gis):
+		for chunk in chunks(gis):
+			self.keyChunks.append(numpy.array([int(gi) for gi in chunk], dtype=numpy.uint64))
+		return self
+
+	def freeze(self):
+		self.keys = numpy.unique(numpy.concatenate([self.keys] + self.keyChunks))
+		self.keyChunks = []
+		return self
+
+	def __contains__(self, gi):
+		return _contains(self.keys, int(gi))
+
+	def __len__(self):
+		return len(self.keys)
+
+	def nbytes(self):
+		return self.keys.nbytes
+
+
+def _contains(keys, key):
+	# a plain int would promote the uint64 comparison to float64
+	key = numpy.uint64(key)
+	i = keys.searchsorted(key)
+	return i < len(keys) and keys[i] == key
+
+def chunks(iterable, size=CHUNK_SIZE):
+	iterable = iter(iterable)
+	while True:
+		chunk = list(itertools.islice(iterable, size))
+		if not chunk:
+			return
+		yield chunk
+
+def newRemovalSet(ref):
+	if ref == 'gi':
+		return GISet()
+	return AccessionSet()
+
+def describeRemovalSet(remove):
+	return "%d identifiers in %.1f MB" % (len(remove), remove.nbytes() / 1048576.0)
+
+
+def readRemovalList(fileName, ref):
+	"""Return the set of identifiers (ref is 'acc' or 'gi') listed one per line in fileName."""
+	with open(fileName) as f:
+		return newRemovalSet(ref).update(line.strip() for line in f if line.strip()).freeze()
+
+
+# Replaces one "SELECT acc FROM acc_taxid WHERE taxid = ?" per taxid
+# (NCBI_taxid_to_gb.pl) and the intermediate identifier file: the taxids go
+# into a temporary table and a single join streams the identifiers back.
+def queryRemovalSet(taxDatabase, ref, taxidFile):
+	"""Return the set of identifiers (ref is 'acc' or 'gi') whose taxid is listed in taxidFile.
+
+	taxDatabase is an (acc|gi)_taxid_(nucl|prot).db built by create_taxonomy_db.py.
+	"""
+	remove = newRemovalSet(ref)
+	conn = sqlite3.connect(taxDatabase)
+	try:
+		conn.execute("CREATE TEMP TABLE remove_taxid (taxid INTEGER PRIMARY KEY)")
+		with open(taxidFile) as f:
+			conn.executemany("INSERT OR IGNORE INTO remove_taxid VALUES (?)",
+					((int(line),) for line in f if line.strip()))
+		rows = conn.execute("SELECT %(ref)s FROM %(ref)s_taxid JOIN remove_taxid USING (taxid)" % {'ref': ref})
+		remove.update(str(row[0]) for row in rows)
+	finally:
+		conn.close()
+	return remove.freeze()
+
+
+# Records are never parsed: the input is read in large blocks, the keep or
+# drop decision is made from the header line alone and the bytes of each
+# record are copied verbatim, including the original line wrapping, to the
+# retained or removed output.
+BLOCK_SIZE = 16 * 1024 * 1024
+# Shards are small and appended to the outputs in order as they finish, with
+# no more than one per worker waiting, so the shard files never hold more than
+# a few shards' worth of the output, e.g., of a several hundred GB nt FASTA.
+SHARD_SIZE = 256 * 1024 * 1024
+
+def filterFasta(fastaFile, reKey, remove, resultFile, removeFile, workers=1):
+	"""Write sequences whose key is not in remove to resultFile and the rest to removeFile.
+
+	reKey extracts the key from the sequence id as group 1. With more than
+	one worker the input is filtered in shards by separate processes.
+	Returns the number of sequences retained and removed.
+	"""
+	global job
+	job = FilterJob(fastaFile, reKey, remove, resultFile, removeFile)
+	if workers <= 1:
+		with open(fastaFile, 'rb') as f, open(resultFile, 'wb', BLOCK_SIZE) as retained, open(removeFile, 'wb', BLOCK_SIZE) as removed:
+			return splitFasta(f, job.keep, retained, removed)
+
+	shards = shardOffsets(fastaFile, max(workers * 4, os.path.getsize(fastaFile) // SHARD_SIZE))
+	# workers are forked after job is set, so they inherit the removal set
+	# read-only instead of receiving a pickled copy
+	workers = min(workers, len(shards))
+	pool = multiprocessing.Pool(workers)
+	counts = [0, 0] # retained, removed
+	submitted = 0
+	try:
+		with open(resultFile, 'wb') as retainedOut, open(removeFile, 'wb') as removedOut:
+			def append(result):
+				i, retained, removed, elapsed = result
+				print "# shard %d: %d retained, %d removed (%.1f s)" % (i, retained, removed, elapsed)
+				counts[0] += retained
+				counts[1] += removed
+				appendShard(retainedOut, shardName(resultFile, i))
+				appendShard(removedOut, shardName(removeFile, i))
+
+			results = collections.deque()
+			for i, (start, end) in enumerate(shards):
+				results.append(pool.apply_async(filterShard, ((i, start, end),)))
+				submitted = i + 1
+				if len(results) > workers:
+					append(results.popleft().get())
+			while results:
+				append(results.popleft().get())
+	except:
+		# stop the other shards and remove what they have written
+		pool.terminate()
+		pool.join()
+		for i in range(submitted):
+			for fileName in (resultFile, removeFile):
+				name = shardName(fileName, i)
+				if os.path.exists(name):
+					os.remove(name)
+		raise
+	pool.close()
+	pool.join()
+	return counts[0], counts[1]
+
+
+class FilterJob(object):
+	"""What to filter and how; shared with shard workers by fork."""
+
+	def __init__(self, fastaFile, reKey, remove, resultFile, removeFile):
+		self.fastaFile = fastaFile
+		self.reKey = reKey
+		self.remove = remove
+		self.resultFile = resultFile
+		self.removeFile = removeFile
+
+	def keep(self, name):
+		m = self.reKey.match(name)
+		return m is not None and m.group(1) not in self.remove and len(name) > 0
+
+job = None
+
+
+def shardOffsets(fastaFile, count):
+	"""Return up to count (start, end) byte ranges of fastaFile, each starting at a record."""
+	size = os.path.getsize(fastaFile)
+	starts = [0]
+	with open(fastaFile, 'rb') as f:
+		for i in range(1, count):
+			offset = max(size * i // count, starts[-1])
+			f.seek(offset)
+			# move forward to the next '>' that starts a line
+			buf = f.read(BLOCK_SIZE)
+			while buf:
+				j = buf.find('\n>')
+				if j >= 0:
+					offset += j + 1
+					break
+				# keep the last byte in case '\n' and '>' straddle blocks
+				offset += len(buf) - 1
+				f.seek(offset)
+				buf = f.read(BLOCK_SIZE)
+				if len(buf) <= 1:
+					buf = ''
+			else:
+				offset = size
+			if offset > starts[-1]:
+				starts.append(offset)
+	ends = starts[1:] + [size]
+	return [(start, end) for start, end in zip(starts, ends) if end > start] or [(0, size)]
+
+
+class RangeFile(object):
+	"""Read-only view of bytes start to end of a file."""
+
+	def __init__(self, f, start, end):
+		self.f = f
+		self.remaining = end - start
+		f.seek(start)
+
+	def read(self, size):
+		size = min(size, self.remaining)
+		if size <= 0:
+			return ''
+		data = self.f.read(size)
+		self.remaining -= len(data)
+		return data
+
+
+def shardName(fileName, i):
+	return "%s.shard%03d" % (fileName, i)
+
+def filterShard(args):
+	i, start, end = args
+	began = time.time()
+	with open(job.fastaFile, 'rb') as f, open(shardName(job.resultFile, i), 'wb', BLOCK_SIZE) as retained, open(shardName(job.removeFile, i), 'wb', BLOCK_SIZE) as removed:
+		retained_sequences, removed_sequences = splitFasta(RangeFile(f, start, end), job.keep, retained, removed)
+	return i, retained_sequences, removed_sequences, time.time() - began
+
+def appendShard(out, name):
+	with open(name, 'rb') as f:
+		shutil.copyfileobj(f, out, BLOCK_SIZE)
+	os.remove(name)
+
+
+def splitFasta(f, keep, retained, removed, blockSize=BLOCK_SIZE):
+	"""Copy each record of FASTA file f to retained if keep(id) is true, otherwise to removed.
+
+	id is the first word of the header, as in Bio.SeqIO. Anything before the
+	first header is dropped. Returns the number of records retained and removed.
+	"""
+	counts = [0, 0] # removed, retained
+	out = None
+	# sentinel newline so a header at the very start looks like any other
+	buf = '\n' + f.read(blockSize)
+	pos = 0 # buf[:pos] has been written
+	while True:
+		start = buf.find('\n>', pos)
+		if start < 0:
+			# all of buf belongs to the current record, but hold back a
+			# trailing newline in case the next block starts with '>'
+			end = len(buf) - 1 if buf.endswith('\n') else len(buf)
+			if out is not None:
+				out.write(buf[pos:end])
+			block = f.read(blockSize)
+			if not block:
+				if out is not None:
+					out.write(buf[end:])
+				break
+			buf = buf[end:] + block
+			pos = 0
+			continue
+
+		# the newline before '>' ends the current record
+		if out is not None:
+			out.write(buf[pos:start + 1])
+		start += 1
+		eol = buf.find('\n', start)
+		while eol < 0:
+			# header line continues into the next block
+			block = f.read(blockSize)
+			buf = buf[start:] + block
+			start = 0
+			if not block:
+				eol = len(buf)
+				break
+			eol = buf.find('\n', start)
+
+		words = buf[start + 1:eol].split(None, 1)
+		name = words[0] if words else ''
+		keeping = keep(name)
+		counts[keeping] += 1
+		out = retained if keeping else removed
+		pos = start
+
+	return counts[1], counts[0]
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+#	fastq_shards.py
+#
+#	Record-aligned byte ranges of a FASTQ file, so that it can be processed
+#	by several workers without first being split into copies on disk.
+#	Chiu Laboratory
+#	University of California, San Francisco
+#
+# Run as a script it prints the ranges or writes one of them to standard
+# output, which is how preprocess_ncores.sh feeds its workers.
+#
+# Records are four lines. A header line starts with '@', but so may a
+# quality line, so a record is taken to start at a line beginning with '@'
+# whose third line begins with '+'. A sequence line never starts with '+'.
+#
+
+import mmap
+import os
+import sys
+
+def mapFile(fileName):
+	"""Return a read-only mmap of fileName, or None if the file is empty."""
+	if os.path.getsize(fileName) == 0:
+		return None
+	with open(fileName, 'rb') as f:
+		# the mapping stays valid after the file is closed
+		return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def nextLine(fastq, offset):
+	"""Return the offset of the line after the one containing offset, or len(fastq)."""
+	eol = fastq.find('\n', offset)
+	return len(fastq) if eol < 0 else eol + 1
+
+def recordStart(fastq, offset):
+	"""Return the offset of the first record starting at or after offset."""
+	size = len(fastq)
+	if offset > 0:
+		# the next line start, unless offset is one already
+		offset = nextLine(fastq, offset - 1)
+	while offset < size:
+		if fastq[offset] == '@':
+			third = nextLine(fastq, nextLine(fastq, offset))
+			if third < size and fastq[third] == '+':
+				return offset
+		offset = nextLine(fastq, offset)
+	return size
+
+def shardOffsets(fastq, count):
+	"""Return up to count (start, end) byte ranges of mmap fastq, each starting at a record."""
+	size = len(fastq)
+	starts = [0]
+	for i in range(1, count):
+		offset = recordStart(fastq, max(size * i // count, starts[-1]))
+		if offset > starts[-1]:
+			starts.append(offset)
+	ends = starts[1:] + [size]
+	return [(start, end) for start, end in zip(starts, ends) if end > start]
+
+def writeRange(fastq, start, end, out, blockSize=16 * 1024 * 1024):
+	"""Write bytes start to end of mmap fastq to file out."""
+	for offset in xrange(start, end, blockSize):
+		out.write(fastq[offset:min(offset + blockSize, end)])
+
+
+def usage():
+	print "Usage: %s offsets <FASTQ file> <count>" % sys.argv[0]
+	print "       %s cat <FASTQ file> <start> <end>" % sys.argv[0]
+	print "  offsets: print up to count record-aligned 'start end' byte ranges, one per line"
+	print "  cat: write the bytes of one range to standard output, e.g., into a named pipe"
+
+if __name__ == '__main__':
+	if len(sys.argv) == 4 and sys.argv[1] == 'offsets':
+		fastq = mapFile(sys.argv[2])
+		if fastq is not None:
+			for start, end in shardOffsets(fastq, int(sys.argv[3])):
+				print start, end
+	elif len(sys.argv) == 5 and sys.argv[1] == 'cat':
+		fastq = mapFile(sys.argv[2])
+		if fastq is not None:
+			writeRange(fastq, int(sys.argv[3]), int(sys.argv[4]), sys.stdout)
+	else:
+		usage()
+		sys.exit(2)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#
+#	join_fulllength.py
+#
+#	Replace the sequence and quality of each SNAP hit with those of the
+#	full-length read, producing the .fl.all.annotated file.
+#	Chiu Laboratory
+#	University of California, San Francisco
+#
+# SURPI.sh used to extract the matched reads from the cutadapt FASTQ, sort
+# both the SAM and the flattened FASTQ by read name and paste the columns
+# back together, which took two external sorts and five temporary copies.
+# Here the SAM read names are collected first, the FASTQ is scanned once to
+# record the byte offset of each of those reads, and the SAM is then
+# streamed, taking each read's sequence and quality lines straight from the
+# memory-mapped FASTQ. Lines are written in SAM order and otherwise match
+# the paste output: SAM fields 1-9, sequence, quality, SAM fields 12 on.
+#
+# FASTQ header lines must be exactly '@' followed by the read name, as
+# fqextract requires.
+#
+
+import mmap
+import sys
+import time
+
+BUFFER_SIZE = 16 * 1024 * 1024
+
+def readNames(samFile):
+	"""Return a dictionary of SAM read names, to be filled with FASTQ offsets."""
+	offsets = {}
+	with open(samFile, 'rb', BUFFER_SIZE) as f:
+		for line in f:
+			if line.startswith('@'):
+				continue
+			offsets[line.split('\t', 1)[0].rstrip('\n')] = None
+	return offsets
+
+def indexFastq(fastqFile, offsets):
+	"""Record in offsets the byte offset of the sequence line of each wanted read."""
+	offset = 0
+	with open(fastqFile, 'rb', BUFFER_SIZE) as f:
+		for lineno, line in enumerate(f):
+			if lineno % 4 == 0:
+				name = line[1:].rstrip('\n')
+				if name in offsets and offsets[name] is None:
+					offsets[name] = offset + len(line)
+			offset += len(line)
+
+def join(samFile, fastqFile, outputFile):
+	"""Write the annotated file; return the number of lines or raise KeyError for a missing read."""
+	offsets = readNames(samFile)
+	indexFastq(fastqFile, offsets)
+	missing = [name for name, offset in offsets.iteritems() if offset is None]
+	if missing:
+		raise KeyError("%d reads in %s not found in %s, e.g., '%s'" % (
+				len(missing), samFile, fastqFile, missing[0]))
+
+	count = 0
+	with open(fastqFile, 'rb') as fq, open(samFile, 'rb', BUFFER_SIZE) as sam, open(outputFile, 'wb', BUFFER_SIZE) as out:
+		if not offsets:
+			return count
+		fastq = mmap.mmap(fq.fileno(), 0, access=mmap.ACCESS_READ)
+		for line in sam:
+			if line.startswith('@'):
+				continue
+			fields = line.rstrip('\n').split('\t')
+			# sequence, '+' and quality lines
+			start = offsets[fields[0]]
+			sequenceEnd = fastq.find('\n', start)
+			qualityStart = fastq.find('\n', sequenceEnd + 1) + 1
+			qualityEnd = fastq.find('\n', qualityStart)
+			if qualityEnd < 0:
+				qualityEnd = len(fastq)
+			out.write('%s\t%s\t%s\t%s\n' % ('\t'.join(fields[:9]), fastq[start:sequenceEnd],
+					fastq[qualityStart:qualityEnd], '\t'.join(fields[11:])))
+			count += 1
+		fastq.close()
+	return count
+
+
+def usage():
+	print "Usage: %s <SNAP SAM file> <full-length FASTQ file> <output annotated file>" % sys.argv[0]
+	print "  full-length FASTQ file: e.g., the cutadapt FASTQ; every SAM read must be present"
+
+if __name__ == '__main__':
+	if len(sys.argv) != 4:
+		usage()
+		sys.exit(2)
+
+	start = time.time()
+	try:
+		count = join(sys.argv[1], sys.argv[2], sys.argv[3])
+	except KeyError, e:
+		print >> sys.stderr, "ERROR: %s" % e.args[0]
+		sys.exit(1)
+	print "# %d annotated lines written to %s in %.1f s" % (count, sys.argv[3], time.time() - start)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#
+#	partition_annotated.py
+#
+#	Split the full-length annotated SAM file into the taxonomic .annotated
+#	files in a single pass.
+#	Chiu Laboratory
+#	University of California, San Francisco
+#
+# SURPI.sh used to build these files with a cascade of grep and grep -v
+# passes, each rereading the whole annotated file. Every line is now tested
+# once and written to each bucket it belongs to. The tests are the same
+# substring tests the greps made, including where they do and do not
+# require the trailing ';', so the outputs are byte-identical:
+#
+#	Viruses				"Viruses;"
+#	Bacteria			"Bacteria;"
+#	Primates			"Primates;"
+#	nonPrimMammal		"Mammalia" and not "Primates"
+#	nonMammalChordat	"Chordata" and not "Mammalia"
+#	nonChordatEuk		"Eukaryota" and not "Chordata", "Viridiplantae" or "Arthropoda;"
+#	Plants				"Viridiplantae;"
+#	Arthropoda			"Arthropoda;"
+#	Fungi				nonChordatEuk and "Fungi;"
+#	Parasite			nonChordatEuk and not "Fungi;"
+#
+# Bacteria, Fungi and Parasite lines whose edit distance passes the
+# secondary cutoff, i.e., grep -P 'NM:i:([0-<cutoff>](?!\d))', are also
+# written to the secondary cutoff files.
+#
+
+import re
+import sys
+import time
+
+BUFFER_SIZE = 16 * 1024 * 1024
+
+BUCKETS = [
+	'Viruses', 'Bacteria', 'Primates', 'nonPrimMammal', 'nonMammalChordat',
+	'nonChordatEuk', 'Plants', 'Arthropoda', 'Fungi', 'Parasite',
+]
+SECONDARY_BUCKETS = ['Bacteria', 'Fungi', 'Parasite']
+
+def partition(annotatedFile, prefix, secondaryPrefix, cutoff):
+	"""Write <prefix>.<bucket>.annotated and <secondaryPrefix>.<bucket>.annotated files.
+
+	Returns a dictionary of line counts by output file name.
+	"""
+	reSecondary = re.compile(r'NM:i:([0-%s](?!\d))' % cutoff)
+	fileNames = [('%s.%s.annotated' % (prefix, bucket)) for bucket in BUCKETS]
+	fileNames.extend('%s.%s.annotated' % (secondaryPrefix, bucket) for bucket in SECONDARY_BUCKETS)
+	outputs = [open(fileName, 'wb', BUFFER_SIZE) for fileName in fileNames]
+	(viruses, bacteria, primates, nonPrimMammal, nonMammalChordat, nonChordatEuk,
+			plants, arthropods, fungi, parasite, bacteria2, fungi2, parasite2) = [f.write for f in outputs]
+	counts = [0] * len(outputs)
+
+	with open(annotatedFile, 'rb', BUFFER_SIZE) as f:
+		for line in f:
+			# grep terminates an unterminated last line
+			if not line.endswith('\n'):
+				line += '\n'
+
+			if 'Viruses;' in line:
+				viruses(line)
+				counts[0] += 1
+			if 'Bacteria;' in line:
+				bacteria(line)
+				counts[1] += 1
+				if reSecondary.search(line):
+					bacteria2(line)
+					counts[10] += 1
+			if 'Primates;' in line:
+				primates(line)
+				counts[2] += 1
+			if 'Mammalia' in line:
+				if 'Primates' not in line:
+					nonPrimMammal(line)
+					counts[3] += 1
+			elif 'Chordata' in line:
+				nonMammalChordat(line)
+				counts[4] += 1
+			if 'Chordata' not in line and 'Viridiplantae' not in line and 'Eukaryota' in line and 'Arthropoda;' not in line:
+				nonChordatEuk(line)
+				counts[5] += 1
+				secondary = reSecondary.search(line)
+				if 'Fungi;' in line:
+					fungi(line)
+					counts[8] += 1
+					if secondary:
+						fungi2(line)
+						counts[11] += 1
+				else:
+					parasite(line)
+					counts[9] += 1
+					if secondary:
+						parasite2(line)
+						counts[12] += 1
+			if 'Viridiplantae;' in line:
+				plants(line)
+				counts[6] += 1
+			if 'Arthropoda;' in line:
+				arthropods(line)
+				counts[7] += 1
+
+	for f in outputs:
+		f.close()
+	return dict(zip(fileNames, counts))
+
+
+def usage():
+	print "Usage: %s <annotated file> <output prefix> <secondary output prefix> <secondary cutoff>" % sys.argv[0]
+	print "  annotated file: full-length annotated SAM, e.g., <base>.NT.snap.matched.d16.fl.all.annotated"
+	print "  output prefix: writes <output prefix>.<taxon>.annotated for %s" % ', '.join(BUCKETS)
+	print "  secondary output prefix: writes <secondary output prefix>.<taxon>.annotated for %s" % ', '.join(SECONDARY_BUCKETS)
+	print "  secondary cutoff: highest edit distance (NM:i:) kept in the secondary output files"
+
+if __name__ == '__main__':
+	if len(sys.argv) != 5:
+		usage()
+		sys.exit(2)
+
+	start = time.time()
+	counts = partition(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
+	for fileName, count in sorted(counts.items()):
+		print "# %s: %d" % (fileName, count)
+	print "# partitioned %s in %.1f s" % (sys.argv[1], time.time() - start)
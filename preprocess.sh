@@ -13,8 +13,9 @@
 
 scriptname=${0##*/}
 
-if [ $# != 9 ]; then
-	echo "Usage: $scriptname <R1 FASTQ file> <S/I quality> <Y/N uniq> <length_cutoff; 0 for no length_cutoff> <Y/N keep short reads> <adapter_set> <start_nt> <crop_length> <quality_cutoff>"
+if [ $# != 9 ] && [ $# != 10 ]; then
+	echo "Usage: $scriptname <R1 FASTQ file> <S/I quality> <Y/N uniq> <length_cutoff; 0 for no length_cutoff> <Y/N keep short reads> <adapter_set> <start_nt> <crop_length> <quality_cutoff> [SPACE/NOSPACE in header]"
+	echo "  The header check is read from the input unless given; give it when the input is a named pipe, which can only be read once."
 	exit
 fi
 
@@ -28,9 +29,10 @@ adapter_set=$6
 start_nt=$7
 crop_length=$8
 quality_cutoff=$9
+header_space=${10}
 ###
 
-if [ ! -f $inputfile ];
+if [ ! -e $inputfile ];
 then
 	echo "$inputfile not found!"
 	exit
@@ -44,7 +46,12 @@ else
 fi
 
 # fix header if space is present
-s=`head -1 $inputfile | awk '{if ($0 ~ / /) {print "SPACE"} else {print "NOSPACE"}}'`
+if [ -n "$header_space" ]
+then
+	s=$header_space
+else
+	s=`head -1 $inputfile | awk '{if ($0 ~ / /) {print "SPACE"} else {print "NOSPACE"}}'`
+fi
 
 echo -e "$(date)\t$scriptname\t$s in header"
 
@@ -43,40 +43,46 @@ echo -e "$(date)\t$scriptname\tThere is $freemem GB available free memory...[cut
 
 START=$(date +%s)
 
-echo -e "$(date)\t$scriptname\tSplitting $inputfile..."
-
-let "numlines = `wc -l $inputfile | awk '{print $1}'`"
-let "FASTQentries = numlines / 4"
-echo -e "$(date)\t$scriptname\tThere are $FASTQentries FASTQ entries in $inputfile"
-let "LinesPerCore = numlines / $cores"
-let "FASTQperCore = LinesPerCore / 4"
-let "SplitPerCore = FASTQperCore * 4"
-echo -e "$(date)\t$scriptname\twill use $cores cores with $FASTQperCore entries per core"
-
-split -l "$SplitPerCore" "$inputfile" "$prefix"
+# The input is not split into copies on disk: fastq_shards.py finds
+# record-aligned byte ranges and streams each range into a named pipe that
+# one preprocess.sh reads in place of its chunk file. preprocess.sh cannot
+# inspect a pipe before reading it, so the header check is made once here.
+echo -e "$(date)\t$scriptname\tSharding $inputfile..."
+
+header_space=$(head -1 "$inputfile" | awk '{if ($0 ~ / /) {print "SPACE"} else {print "NOSPACE"}}')
+shards=()
+starts=()
+ends=()
+while read start end
+do
+	shards+=("$(printf "%s%02d" "$prefix" ${#shards[@]})")
+	starts+=("$start")
+	ends+=("$end")
+done < <(fastq_shards.py offsets "$inputfile" "$cores")
+echo -e "$(date)\t$scriptname\twill use ${#shards[@]} cores"
 
 END_SPLIT=$(date +%s)
 diff_SPLIT=$(( END_SPLIT - START ))
 
-echo -e "$(date)\t$scriptname\tDone splitting: "
+echo -e "$(date)\t$scriptname\tDone sharding: "
 echo -e "$(date)\t$scriptname\tSPLITTING took $diff_SPLIT seconds"
 
 echo -e "$(date)\t$scriptname\tRunning preprocess script for each chunk..."
 
-for f in ${prefix}??
-do
-	mv "$f" "$f.fastq"
-	echo -e "$(date)\t$scriptname\tpreprocess.sh $f.fastq $quality N $length_cutoff $keep_short_reads $adapter_set $start_nt $crop_length >& $f.preprocess.log &"
-	preprocess.sh "$f.fastq" "$quality" N "$length_cutoff" "$keep_short_reads" "$adapter_set" "$start_nt" "$crop_length" "$quality_cutoff" >& "$f.preprocess.log" &
-done
-
-for job in `jobs -p`
+pids=()
+feeders=()
+for i in "${!shards[@]}"
 do
-	wait $job
+	f=${shards[$i]}
+	rm -f "$f.fastq"
+	mkfifo "$f.fastq"
+	fastq_shards.py cat "$inputfile" "${starts[$i]}" "${ends[$i]}" > "$f.fastq" &
+	feeders+=($!)
+	echo -e "$(date)\t$scriptname\tpreprocess.sh $f.fastq $quality N $length_cutoff $keep_short_reads $adapter_set $start_nt $crop_length $quality_cutoff $header_space >& $f.preprocess.log &"
+	preprocess.sh "$f.fastq" "$quality" N "$length_cutoff" "$keep_short_reads" "$adapter_set" "$start_nt" "$crop_length" "$quality_cutoff" "$header_space" >& "$f.preprocess.log" &
+	pids+=($!)
 done
 
-echo -e "$(date)\t$scriptname\tDone preprocessing for each chunk..."
-
 nopathf2=${1##*/}
 basef2=${nopathf2%.fastq}
 
@@ -84,10 +90,24 @@ rm -f "$basef2.cutadapt.fastq"
 rm -f "$basef2.preprocessed.fastq"
 rm -f "$basef2*.dusted.bad.fastq"
 
-for f in ${prefix}??.fastq
+# merge each chunk as soon as it and the chunks before it are done, so the
+# chunk outputs are removed while later chunks are still running
+failed=0
+for i in "${!shards[@]}"
 do
-	nopathf=${f##*/}
-	basef=${nopathf%.fastq}
+	wait ${pids[$i]}
+	status=$?
+	basef=${shards[$i]}
+	# a preprocess.sh that exited without reading its pipe leaves the
+	# feeder blocked opening it
+	kill ${feeders[$i]} 2> /dev/null
+	wait ${feeders[$i]} 2> /dev/null
+	if [ $status -ne 0 ]
+	then
+		echo -e "$(date)\t$scriptname\tpreprocess.sh failed on $basef.fastq with status $status"
+		failed=$status
+	fi
+	echo -e "$(date)\t$scriptname\tDone preprocessing $basef.fastq, concatenating output..."
 	cat "$basef.preprocess.log" >> "$basef2.preprocess.log"
 	rm -f "$basef.preprocess.log"
 	cat "$basef.modheader.cutadapt.summary.log" >> "$basef2.cutadapt.summary.log"
@@ -103,7 +123,7 @@ do
 	cat "$basef.cutadapt.cropped.dusted.bad.fastq" >> "$basef2.cutadapt.cropped.dusted.bad.fastq"
 	rm -f "$basef.cutadapt.cropped.dusted.bad.fastq" 
 
-	rm -f "$f"
+	rm -f "$basef.fastq"
 	rm -f "$basef.modheader.fastq"
 	rm -f "$basef.cutadapt.summary.log"
 	rm -f "$basef.adapterinfo.log"
@@ -112,14 +132,18 @@ done
 
 echo -e "$(date)\t$scriptname\tDone concatenating output..."
 
+if [ $failed -ne 0 ]
+then
+	echo -e "$(date)\t$scriptname\tpreprocessing failed, see $basef2.preprocess.log" >&2
+	exit $failed
+fi
+
 if [ "$run_uniq" == "Y" ] # selecting unique reads
 then
 	echo -e "$(date)\t$scriptname\tSelecting unique reads"
 	START_UNIQ=$(date +%s)
 	# selecting unique reads
-	sed "n;n;n;d" "$basef2.preprocessed.fastq" | sed "n;n;d" | sed "s/^@/>/g" > "$basef2.preprocessed.fasta"
-	gt sequniq -force -o "$basef2.uniq.fasta" "$basef2.preprocessed.fasta"
-	extractHeaderFromFastq.csh "$basef2.uniq.fasta" FASTA "$basef2.preprocessed.fastq" "$basef2.uniq.fastq"
+	uniq_fastq.py "$basef2.preprocessed.fastq" "$basef2.uniq.fastq"
 	cp -f "$basef2.uniq.fastq" "$basef2.preprocessed.fastq"
 	END_UNIQ=$(date +%s)
 	diff_UNIQ=$(( END_UNIQ - START_UNIQ ))
@@ -1,40 +1,49 @@
 #!/usr/bin/env python
 
-#This program receives 3 arguments:
+#This program receives 4 arguments:
 # 1 - Input file (in FASTA format)
 # The assumption is that the header is in the following format:
 # name is gi|4|emb|X17276.1|
 # i.e. gi is the second field, using | as a delimiter
 
 # 2 - gi list - these gi will be removed from the inputfile
+#     With --taxdb, a taxid list instead: gi of these taxids are
+#     looked up in the given gi_taxid database and removed
 # 3 - Output filename (in FASTA format)
+# 4 - Output filename for removed sequences (in FASTA format)
+# --workers N filters N record-aligned byte ranges of the input in parallel
+import getopt
 import re
 import sys
-from Bio import SeqIO
 
-usage = "remove_gi_from_fasta.py <inputfile (FASTA)> <gi to remove> <output file (retained FASTA)> <output file (removed FASTA)>"
+import fasta_filter
 
-if len(sys.argv) < 3:
-	print usage
-	sys.exit(0)
+usage = "remove_gi_from_fasta.py [--taxdb <gi_taxid db>] [--workers <N>] <inputfile (FASTA)> <gi to remove | taxid to remove with --taxdb> <output file (retained FASTA)> <output file (removed FASTA)>"
 
+options, args = getopt.getopt(sys.argv[1:], "", ['taxdb=', 'workers='])
+taxDatabase = None
+workers = 1
+for option, value in options:
+	if option == '--taxdb':
+		taxDatabase = value
+	elif option == '--workers':
+		workers = int(value)
 
-fasta_file = sys.argv[1]  # Input fasta file
-gi_to_remove_file = sys.argv[2] # Input wanted file, one gene name per line
-result_file = sys.argv[3] # Output fasta file
-remove_file = sys.argv[4] # Output removed sequences FASTA file
+if len(args) < 4:
+	print usage
+	sys.exit(0)
 
-remove = set()
-with open(gi_to_remove_file) as f:
-	for line in f:
-		line = line.strip()
-		if line != "":
-			remove.add(line)
 
-fasta_sequences = SeqIO.parse(open(fasta_file),'fasta')
+fasta_file = args[0]  # Input fasta file
+gi_to_remove_file = args[1] # Input wanted file, one gene name (or taxid) per line
+result_file = args[2] # Output fasta file
+remove_file = args[3] # Output removed sequences FASTA file
 
-retained_sequences = 0
-removed_sequences = 0
+if taxDatabase:
+	remove = fasta_filter.queryRemovalSet(taxDatabase, 'gi', gi_to_remove_file)
+else:
+	remove = fasta_filter.readRemovalList(gi_to_remove_file, 'gi')
+print "# gi to remove:", fasta_filter.describeRemovalSet(remove)
 
 # Example nt entry
 # >gi|33|emb|X60496.1| B.taurus exon 2 for bovine seminal vesicle secretory...
@@ -43,16 +52,7 @@ removed_sequences = 0
 # strip here
 # 33
 reGI = re.compile(r'^gi\|(\d+)\|.*$')
-with open(result_file, "w") as f, open(remove_file, "w") as g:
-	for fasta in fasta_sequences:
-		name = fasta.id
-		m = reGI.match(name)
-		if m is not None and m.group(1) not in remove and len(name) > 0:
-			SeqIO.write([fasta], f, "fasta")
-			retained_sequences +=1
-		else:
-			SeqIO.write([fasta], g, "fasta")
-			removed_sequences +=1
+retained_sequences, removed_sequences = fasta_filter.filterFasta(fasta_file, reGI, remove, result_file, remove_file, workers)
 
 print "# sequences retained: ", retained_sequences
 print "# sequences removed:", removed_sequences
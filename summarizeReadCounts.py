@@ -8,14 +8,22 @@
 #
 
 import collections
+import copy
 import itertools
+import multiprocessing
 import operator
 import os
 import re
 import sys
 import warnings
 
+import numpy
 import openpyxl
+from openpyxl.styles import NamedStyle
+try:
+	from openpyxl.cell import WriteOnlyCell
+except ImportError: # openpyxl < 2.5
+	from openpyxl.writer.write_only import WriteOnlyCell
 
 sys.path.append(os.path.join(sys.path[0], '../lib/python'))
 from SURPIviz import SampleSheet
@@ -72,16 +80,21 @@ reBarcodes = [
 	re.compile(r'^bar#@?(?P<barcode>(\+|\w)+)(/|(/[12]))?$'), 	# e.g., bar#GCCAAT or bar#GCCAAT/ or bar#GCCAAT/2
 	re.compile(r'^#?(?P<barcode>(\+|\w)+)/?'), 					# e.g., #TGACCA or #TGACCA/
 ]
+# the same few barcodes recur for every file in the read count log
+extractedBarcodes = {}
 def extractBarcode(barcode):
 	"""Return just the barcode from the various extant embeddings, if possible."""
-	for reBarcode in reBarcodes:
-		m = reBarcode.match(barcode)
-		if m is not None:
-			break
-	else:
-		return barcode
-
-	return m.group('barcode')
+	extracted = extractedBarcodes.get(barcode)
+	if extracted is None:
+		for reBarcode in reBarcodes:
+			m = reBarcode.match(barcode)
+			if m is not None:
+				extracted = m.group('barcode')
+				break
+		else:
+			extracted = barcode
+		extractedBarcodes[barcode] = extracted
+	return extracted
 
 def addSampleToBarcode(sampleDict, barcode):
 	"""Return the barcode with sample prepended, if available."""
@@ -95,14 +108,68 @@ def addSampleToBarcode(sampleDict, barcode):
 
 	return "%s %s" % (sample, extractedBarcode)
 
+# Template cells live in the workbook being written, so a new cell shares the
+# template cell's style ids rather than copying its six style objects.
 def copyCellStyle(cell, newCell):
 	if cell.has_style:
-		newCell.font = cell.font.copy()
-		newCell.border = cell.border.copy()
-		newCell.fill = cell.fill.copy()
-		newCell.number_format = cell.number_format
-		newCell.protection = cell.protection.copy()
-		newCell.alignment = cell.alignment.copy()
+		newCell._style = copy.copy(cell._style)
+
+# Streaming output cannot share style ids with the template workbook, so each
+# distinct template style is registered once as a named style of the output
+# workbook and cells refer to it by name (see SummaryWorkbook.getStyleName).
+def addNamedStyle(wb, name, cell):
+	"""Register the style of a template cell as a named style of wb."""
+	style = NamedStyle(name=name)
+	if cell.has_style:
+		style.font = cell.font.copy()
+		style.border = cell.border.copy()
+		style.fill = cell.fill.copy()
+		style.number_format = cell.number_format
+		style.protection = cell.protection.copy()
+		style.alignment = cell.alignment.copy()
+	wb.add_named_style(style)
+	return name
+
+def writeOnlyCell(ws, value, styleName):
+	cell = WriteOnlyCell(ws, value=value)
+	cell.style = styleName
+	return cell
+
+def copySettings(source, target):
+	"""Copy the serialised attributes of an openpyxl sheet setting object."""
+	for name in source.__attrs__ + source.__elements__:
+		setattr(target, name, copy.deepcopy(getattr(source, name)))
+
+def copySheetSettings(ws, out):
+	"""Copy sheet settings of a worksheet to an empty write-only worksheet.
+
+	Row settings must be in place before any row is appended. Conditional
+	formatting, sheet protection, print titles, comments, images and
+	charts are not copied.
+	"""
+	for key, dimension in ws.column_dimensions.items():
+		outDimension = out.column_dimensions[key]
+		outDimension.width = dimension.width
+		outDimension.hidden = dimension.hidden
+		outDimension.outline_level = dimension.outline_level
+		outDimension.collapsed = dimension.collapsed
+	for key, dimension in ws.row_dimensions.items():
+		outDimension = out.row_dimensions[key]
+		outDimension.height = dimension.height
+		outDimension.hidden = dimension.hidden
+		outDimension.outline_level = dimension.outline_level
+		outDimension.collapsed = dimension.collapsed
+	for cellRange in ws.merged_cells.ranges:
+		out.merged_cells.add(cellRange.coord)
+	# sheet_view is bound to the write-only sheet's own view, so copy into it
+	copySettings(ws.sheet_view, out.sheet_view)
+	for name in ('sheet_properties', 'sheet_format', 'page_margins',
+			'page_setup', 'print_options', 'auto_filter'):
+		copySettings(getattr(ws, name), getattr(out, name))
+	for validation in ws.data_validations.dataValidation:
+		out.add_data_validation(copy.deepcopy(validation))
+	if ws.print_area:
+		out.print_area = ws.print_area
 
 # writes the formula for calculating humanmatched = preprocessed - humanunmatched
 def humanmatched(sheet, cell):
@@ -272,22 +339,29 @@ class SummarySheet(object):
 	getBarcode = operator.itemgetter(BARCODE)
 	def parseData(self, rowDict):
 		# build data dictionary of values only; ignore functions for now
-		for cellParam, cellValue in self.templateMap.items():
-			# simple lookup using regexp
-			if isinstance(cellValue, basestring):
-				formatDict = {'base': base}
-				reHeading = cellValue % formatDict
-				for heading in rowDict:
-					# have seen differences in case over time, e.g. RAPsearch vs RAPSearch
-					if re.match(reHeading, heading, flags=re.IGNORECASE) is not None:
-						barcodeCounts = rowDict[heading]
-						break
-				else:
-					print "%sno data found for template parameter '%s' using '%s': skipping" % (
-							logHeader(), cellParam, reHeading)
-					continue
+		# each heading is classified once against all lookup patterns
+		reHeadings = self.compileHeadings()
+		for heading in rowDict:
+			m = reHeadings.match(heading)
+			if m is not None and m.lastgroup not in self.dataDict:
+				self.dataDict[m.lastgroup] = rowDict[heading]
 
-				self.dataDict[cellParam] = barcodeCounts
+		for cellParam, cellValue in self.templateMap.items():
+			if isinstance(cellValue, basestring) and cellParam not in self.dataDict:
+				print "%sno data found for template parameter '%s' using '%s': skipping" % (
+						logHeader(), cellParam, cellValue % {'base': base})
+
+	# The lookup patterns are mutually exclusive, so one alternation with a
+	# named group per template parameter tells which parameter, if any, a
+	# heading belongs to.
+	def compileHeadings(self):
+		"""Return one regexp matching a heading against all simple lookup parameters."""
+		formatDict = {'base': base}
+		alternatives = ['(?P<%s>%s)' % (cellParam, cellValue % formatDict)
+				for cellParam, cellValue in sorted(self.templateMap.items())
+				if isinstance(cellValue, basestring)]
+		# have seen differences in case over time, e.g. RAPsearch vs RAPSearch
+		return re.compile('|'.join(alternatives), re.IGNORECASE)
 
 	reCellParam = re.compile(r'^\s*\[\[(\w+)]]\s*$')
 	def collate(self):
@@ -349,59 +423,35 @@ class SummarySheet(object):
 		copyCellStyle(cell, c)
 
 
-class CountTableSheet(object):
-	"""Detail count table."""
+# Count tables are read and parsed in worker processes, so the parsed data is
+# kept apart from the template sheet and only the sheet assembly happens in
+# the main process.
+class CountTable(object):
+	"""Parsed count table: label columns and a numeric count matrix."""
 
-	def __init__(self, ws):
-		self.ws = ws # openpyxl worksheet object from template file
-		self.templateCellDict = {}
+	def __init__(self, filePath):
+		self.filePath = filePath
+		self.fileName = os.path.basename(filePath)
+		self.found = True # False if the file could not be read
 		self.labels = None # species, genus, family
 		self.barcodes = None
 		self.headings = None
-		self.dataRows = None
-
-	def populate(self, wb):
-		self.parseTemplate()
-		for filePath in wb.countTableFiles:
-			if inputDir:
-				filePath = os.path.join(inputDir, filePath)
-			fileName = os.path.basename(filePath)
-			print "%spopulating count table file '%s'" % (
-					logHeader(), filePath)
-			try:
-				headings, dataRows = self.readData(filePath)
-			except IOError:
-				print "%sWARNING: file not found: '%s'" % (logHeader(), filePath)
-				continue
-			self.parseData(fileName, headings, dataRows)
-			self.collate(wb, fileName)
-
-	def parseTemplate(self):
-		"""Build a dictionary of parameterized cells."""
-		for row in self.ws.rows:
-			for cell in row:
-				cellParam = getCellParam(cell)
-				if cellParam is None:
-					# not a cell parameter
-					continue
-
-				self.templateCellDict[cellParam] = cell
+		self.labelRows = None # label values of each row
+		self.counts = None # numpy array of counts, one row per taxon, one column per barcode
+		self.rowTotals = None
+		self.columnTotals = None
 
 	# Samia wants columns sorted by barcode; we assume count tables already sorted.
-	def readData(self, filePath):
-		"""Read a count table and return headings and data rows."""
-		headings = []
-		dataRows = []
-		with open(filePath, 'rU') as f:
-			for line in f:
-				if not headings:
-					headings = [s.strip() for s in line.split('\t')]
-					continue
-				dataRows.append([s.strip() for s in line.split('\t')])
-		return headings, dataRows
-
-	def parseData(self, fileName, headings, dataRows):
+	def readData(self):
+		"""Read the count table and return headings and data lines."""
+		with open(self.filePath, 'rU') as f:
+			headings = [s.strip() for s in f.readline().split('\t')]
+			dataLines = [line.rstrip('\n') for line in f]
+		return headings, dataLines
+
+	def parseData(self, headings, dataLines):
 		"""Validate and organize the count table data into taxa and counts."""
+		fileName = self.fileName
 		# older heading might contain (@=contigbarcode)
 		# newer contains tag label and no 'bar#' prefix
 		# separate out the barcodes
@@ -421,43 +471,119 @@ class CountTableSheet(object):
 						logHeader(), fileName)
 				return
 
-		# validate the data
+		# validate the data and split each line into labels and the text of its counts
 		countStartIndex = len(self.labels)
-		for data in dataRows:
-			if len(data) != len(headings):
+		labelRows = []
+		countText = []
+		for line in dataLines:
+			data = line.split('\t', countStartIndex)
+			if len(data) != countStartIndex + 1 or data[-1].count('\t') != len(self.barcodes) - 1:
 				print "%sline '%s' does not look like a count table" % (
-						logHeader(), data)
+						logHeader(), line.split('\t'))
 				return
-
-			# convert counts to integers
-			for i in range(countStartIndex, len(data)):
-				data[i] = float(data[i])
+			labelRows.append([s.strip() for s in data[:countStartIndex]])
+			countText.append(data[-1])
+
+		# convert all counts at once
+		counts = numpy.fromstring('\t'.join(countText), dtype=float, sep='\t')
+		if counts.size != len(labelRows) * len(self.barcodes):
+			print "%s%s has counts that are not numbers" % (
+					logHeader(), fileName)
+			return
+		self.counts = counts.reshape(len(labelRows), len(self.barcodes))
+		self.rowTotals = self.counts.sum(axis=1)
+		self.columnTotals = self.counts.sum(axis=0)
 
 		self.headings = headings
-		self.dataRows = dataRows
+		self.labelRows = labelRows
+
+def readCountTable(filePath):
+	"""Read and parse one count table file; a missing file is reported by the caller."""
+	table = CountTable(filePath)
+	try:
+		headings, dataLines = table.readData()
+	except IOError:
+		table.found = False
+		return table
+	table.parseData(headings, dataLines)
+	return table
+
+
+class CountTableSheet(object):
+	"""Detail count table."""
+
+	def __init__(self, ws):
+		self.ws = ws # openpyxl worksheet object from template file
+		self.templateCellDict = {}
+		self.styleNames = {} # template parameter to named style when streaming
 
-	def collate(self, wb, fileName):
+	def populate(self, wb):
+		self.parseTemplate()
+		if wb.streaming:
+			for cellParam, cell in self.templateCellDict.items():
+				self.styleNames[cellParam] = wb.getStyleName(cell, cellParam)
+		filePaths = []
+		for filePath in wb.countTableFiles:
+			if inputDir:
+				filePath = os.path.join(inputDir, filePath)
+			filePaths.append(filePath)
+		if not filePaths:
+			return
+
+		# tables come back in command line order so the sheet order is unchanged
+		pool = None
+		if wb.jobs > 1 and len(filePaths) > 1:
+			pool = multiprocessing.Pool(min(wb.jobs, len(filePaths)))
+			tables = pool.imap(readCountTable, filePaths)
+		else:
+			tables = itertools.imap(readCountTable, filePaths)
+		for table in tables:
+			print "%spopulating count table file '%s'" % (
+					logHeader(), table.filePath)
+			if not table.found:
+				print "%sWARNING: file not found: '%s'" % (logHeader(), table.filePath)
+				continue
+			if wb.streaming:
+				self.stream(wb, table)
+			else:
+				self.collate(wb, table)
+		if pool is not None:
+			pool.close()
+			pool.join()
+
+	def parseTemplate(self):
+		"""Build a dictionary of parameterized cells."""
+		for row in self.ws.rows:
+			for cell in row:
+				cellParam = getCellParam(cell)
+				if cellParam is None:
+					# not a cell parameter
+					continue
+
+				self.templateCellDict[cellParam] = cell
+
+	def collate(self, wb, table):
 		"""Apply count table data to new sheet using hard-coded positions and styles from template."""
-		if not self.dataRows:
+		if not table.labelRows:
 			return
 
 		# row and column are 1-based
 		# openpyxl.exceptions.SheetTitleException: Maximum 31 characters allowed in sheet title
-		ws = wb.wb.create_sheet(title=self.getSheetName(fileName))
+		ws = wb.wb.create_sheet(title=self.getSheetName(table.fileName))
 		cell = ws.cell(row=1, column=1)
-		cell.value = fileName
+		cell.value = table.fileName
 		copyCellStyle(self.templateCellDict['filename'], cell)
 
 		# headings consist of labels and barcodes
 		# labels: species, genus, etc.
-		labelCt = len(self.labels)
-		for i, label in enumerate(self.labels):
+		labelCt = len(table.labels)
+		for i, label in enumerate(table.labels):
 			cell = ws.cell(row=2, column=i+1)
 			cell.value = label
 			copyCellStyle(self.templateCellDict['label_heading'], cell)
 
 		# barcodes
-		for i, barcode in enumerate(self.barcodes):
+		for i, barcode in enumerate(table.barcodes):
 			cell = ws.cell(row=2, column=labelCt+i+1)
 			cell.value = addSampleToBarcode(sampleDict, barcode)
 			copyCellStyle(self.templateCellDict['barcode'], cell)
@@ -469,27 +595,49 @@ class CountTableSheet(object):
 		#cell.style = self.templateCellDict['barcode'].style
 
 		# rows of count data
-		for i, data in enumerate(self.dataRows):
-			sum = 0 # totals column
-			for j, datum in enumerate(data):
+		for i, (labelRow, countRow) in enumerate(itertools.izip(table.labelRows, table.counts.tolist())):
+			for j, datum in enumerate(labelRow):
 				cell = ws.cell(row=i+3, column=j+1)
 				cell.value = datum
-				if j < labelCt:
-					copyCellStyle(self.templateCellDict['label_value'], cell)
-				else:
-					copyCellStyle(self.templateCellDict['barcode_count'], cell)
-					sum += datum
+				copyCellStyle(self.templateCellDict['label_value'], cell)
+			for j, datum in enumerate(countRow):
+				cell = ws.cell(row=i+3, column=labelCt+j+1)
+				cell.value = datum
+				copyCellStyle(self.templateCellDict['barcode_count'], cell)
 
 			# FIXME per Samia leave totals off for now
 			# NOTE can have both contig (bar#@CGA) and barcode (bar#CGA)
 			# How does this affect totals??
-			#cell = ws.cell(row=i+3, column=j+2)
-			#cell.value = sum
+			#cell = ws.cell(row=i+3, column=labelCt+j+2)
+			#cell.value = table.rowTotals[i]
 			#cell.style = self.templateCellDict['barcode_count'].style
 
 		cell = ws.cell(row=i+5, column=1)
 		cell.value = SURPI_NOTE
 
+	def stream(self, wb, table):
+		"""Append count table data row by row to a write-only sheet of the streaming workbook."""
+		if not table.labelRows:
+			return
+
+		ws = wb.outWb.create_sheet(title=self.getSheetName(table.fileName))
+		ws.append([writeOnlyCell(ws, table.fileName, self.styleNames['filename'])])
+
+		# headings consist of labels and barcodes
+		headingRow = [writeOnlyCell(ws, label, self.styleNames['label_heading']) for label in table.labels]
+		headingRow.extend(writeOnlyCell(ws, addSampleToBarcode(sampleDict, barcode), self.styleNames['barcode'])
+				for barcode in table.barcodes)
+		ws.append(headingRow)
+
+		# rows of count data
+		for labelRow, countRow in itertools.izip(table.labelRows, table.counts.tolist()):
+			row = [writeOnlyCell(ws, datum, self.styleNames['label_value']) for datum in labelRow]
+			row.extend(writeOnlyCell(ws, datum, self.styleNames['barcode_count']) for datum in countRow)
+			ws.append(row)
+
+		ws.append([])
+		ws.append([SURPI_NOTE])
+
 	def getSheetName(self, fileName):
 		"""Return a shortened but useful name for worksheets."""
 		return fileName.replace(base, '').replace('annotated', '').replace('counttable', '').replace('.', '')[:30]
@@ -502,13 +650,19 @@ class SummaryWorkbook(object):
 		'Count Table Template': CountTableSheet,
 	}
 
-	def __init__(self, readCountFile, countTableFiles):
+	def __init__(self, readCountFile, countTableFiles, streaming=False, jobs=1):
 		self.readCountFile = readCountFile
 		self.countTableFiles = countTableFiles
+		self.streaming = streaming
+		self.jobs = jobs # processes for reading count tables
 		self.wb = None
+		self.outWb = None # write-only output workbook when streaming
+		self.styleNames = {} # template style id to named style when streaming
 
 	def readTemplate(self, fileName):
 		self.wb = openpyxl.load_workbook(filename=fileName)
+		if self.streaming:
+			self.outWb = openpyxl.Workbook(write_only=True)
 
 	def populate(self):
 		names = self.wb.get_sheet_names()
@@ -520,6 +674,34 @@ class SummaryWorkbook(object):
 						logHeader(), ws.title)
 				sheet = self.sheetDict[ws.title](ws)
 				sheet.populate(self)
+				if self.streaming and not ws.title.endswith("Template"):
+					self.streamSheet(ws)
+
+	def streamSheet(self, ws):
+		"""Copy a populated template worksheet into the streaming workbook."""
+		out = self.outWb.create_sheet(title=ws.title)
+		copySheetSettings(ws, out)
+		for row in ws.iter_rows():
+			outRow = []
+			for cell in row:
+				if not cell.has_style:
+					outRow.append(cell.value)
+					continue
+				styleName = self.getStyleName(cell, '%s %d' % (ws.title, cell.style_id))
+				outRow.append(writeOnlyCell(out, cell.value, styleName))
+			out.append(outRow)
+
+	def getStyleName(self, cell, name):
+		"""Return the named style of the streaming workbook for a template cell's style.
+
+		Cells with the same template style share one named style, registered
+		under the name given for the first of them.
+		"""
+		styleName = self.styleNames.get(cell.style_id)
+		if styleName is None:
+			styleName = addNamedStyle(self.outWb, name, cell)
+			self.styleNames[cell.style_id] = styleName
+		return styleName
 
 	def clean(self):
 		"""Perform final housekeeping."""
@@ -534,7 +716,10 @@ class SummaryWorkbook(object):
 		self.wb.remove_sheet(ws)
 
 	def write(self, fileName):
-		self.wb.save(fileName)
+		if self.streaming:
+			self.outWb.save(fileName)
+		else:
+			self.wb.save(fileName)
 
 
 def findSampleSheetFile(fileName):
@@ -578,7 +763,7 @@ def readSampleSheet(fileName):
 
 
 def usage(msg=None):
-	print "Usage: %s [--version] [-d debug] [--input input directory] [--output output directory] [-s samplesheet file] [-r readcount file] <base identifier> <template file> [<counttable file>...]" % sys.argv[0]
+	print "Usage: %s [--version] [-d debug] [--streaming] [--jobs processes] [--input input directory] [--output output directory] [-s samplesheet file] [-r readcount file] <base identifier> <template file> [<counttable file>...]" % sys.argv[0]
 	print "  input directory: source of count table files (default: current directory)"
 	print "  output directory: destination of Excel file (default: current directory)"
 	print "  samplesheet file: optional, one of two formats:"
@@ -586,6 +771,8 @@ def usage(msg=None):
 	print "    Old-style, two-column, tab-delimited file mapping sample names to barcodes"
 	print "         column headings are 'Barcode\tSample' (default: <base>.samplesheet.txt)"
 	print "  readcount file: BarcodeR1R2.log file containing summary of read counts"
+	print "  streaming: write count tables through write-only worksheets to keep memory flat; conditional formatting, sheet protection, print titles, comments, images and charts of the Summary sheet are not kept"
+	print "  processes: number of count table files read and parsed in parallel (default: 1)"
 	print "Translates barcode counts into Excel file using Excel template file."
 	print "Will also translate one or more count tables of any type, e.g., GI, species, genus, family"
 	print "Assumes count column headings begin with 'bar#'"
@@ -600,7 +787,9 @@ if __name__ == '__main__':
 	sampleSheetFile = None
 	readCountFile = None
 	debug = False
-	options, args = getopt.getopt(sys.argv[1:], "dr:s:", ['debug', 'input=', 'output=', 'version'])
+	streaming = False
+	jobs = 1
+	options, args = getopt.getopt(sys.argv[1:], "dr:s:", ['debug', 'input=', 'output=', 'streaming', 'jobs=', 'version'])
 	try:
 		for option, value in options:
 			if option == '--version':
@@ -615,6 +804,10 @@ if __name__ == '__main__':
 				readCountFile = value
 			elif option in ('-d', '--debug'):
 				debug = True
+			elif option == '--streaming':
+				streaming = True
+			elif option == '--jobs':
+				jobs = int(value)
 	except getopt.GetoptError, msg:
 		usage(msg)
 		sys.exit(2)
@@ -638,7 +831,7 @@ if __name__ == '__main__':
 	sampleSheetFile = findSampleSheetFile(sampleSheetFile)
 	readSampleSheet(sampleSheetFile)
 	print "%sgenerating Excel summary file for %s" % (logHeader(), base)
-	wb = SummaryWorkbook(readCountFile, countTableFiles)
+	wb = SummaryWorkbook(readCountFile, countTableFiles, streaming, jobs)
 	wb.readTemplate(templateFile)
 	if readCountFile is None:
 		wb.removeSheet('Summary')
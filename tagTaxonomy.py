@@ -18,6 +18,8 @@
 # Last revised 2015-11-08
 #
 
+import array
+import hashlib
 import operator
 import os
 import re
@@ -130,6 +132,8 @@ def createNewTagTable(taxDatabase):
 		# COLLATE NOCASE makes string matching case-insensitive
 		conn.execute("CREATE TABLE new_tags (taxid INTEGER PRIMARY KEY, %s)"
 				% (', '.join(["%s TEXT" % cat for cat in TaxonTag.categories])))
+		conn.execute("DROP TABLE IF EXISTS new_tag_hashes")
+		conn.execute("CREATE TABLE new_tag_hashes (taxid INTEGER PRIMARY KEY, hash TEXT)")
 
 
 def populateTagsUsingPython(taxDatabase, tagsDict):
@@ -164,41 +168,264 @@ def populateTagsUsingPython(taxDatabase, tagsDict):
 # Note that NCBI taxonomy nodes are almost always unique but not always, e.g., 
 # 78589 and 610258 are both genus "Geomyces" but from different classes!
 def populateTagsUsingSQL(taxDatabase, tagsDict):
+	with sqlite3.connect(taxDatabase) as conn:
+		validTagsDict, newTags = assignTags(conn, tagsDict)
+		if cmd == 'load':
+			conn.executemany(insertTagsSQL('new_tags'), newTags)
+			conn.executemany("INSERT INTO new_tag_hashes (taxid, hash) VALUES (?, ?)",
+					[(row[0], tagHash(row[1:])) for row in newTags])
+
+	return validTagsDict
+
+
+# assignTags pops each tag whose (name, rank) matches exactly one taxid from tagsDict
+# and returns ({(name, rank): TaxonTag}, [[taxid, value,...],...]) for them.
+def assignTags(conn, tagsDict):
 	# Since we tag the taxonomy nodes explicitly, each tag value applies
 	# to exactly one taxid. Use this to validate the tag file.
-	# tagsDict does not contain empty tag values so much specify insert
-	# columns for each row inserted.
-	delimiter = ','
 	validTagsDict = {}
-	with sqlite3.connect(taxDatabase) as conn:
-		conn.row_factory = sqlite3.Row
-		for key in tagsDict.keys():
-			name, rank = key
-			rows = conn.execute("SELECT names.taxid, name, rank FROM names, nodes WHERE names.taxid = nodes.taxid AND name = ? AND rank = ?", (name, rank))
-			rowlist = list(rows) # destroys cursor
-			if len(rowlist) > 1:
-				print "%sambiguous name %s, rank %s matches multiple tax IDs %s: skipping" % (logHeader(), rank, name, ", ".join([str(row[0]) for row in rowlist]))
-				continue
-
-			# second query required to obtain cursor
-			for row in conn.execute("SELECT names.taxid, name, rank FROM names, nodes WHERE names.taxid = nodes.taxid AND name = ? AND rank = ?", (name, rank)):
-				# tags is a dict {category: value,...}
-				ttag = tagsDict.pop(key)
-				validTagsDict[key] = ttag
-				if cmd != 'load':
-					continue
+	newTags = []
+	for key, taxids in sorted(resolveTaxids(conn, tagsDict.keys()).items()):
+		name, rank = key
+		if len(taxids) > 1:
+			print "%sambiguous name %s, rank %s matches multiple tax IDs %s: skipping" % (logHeader(), rank, name, ", ".join(map(str, taxids)))
+			continue
 
-				values = ["'%s'" % ttag.tagDict.get(cat, "") for cat in TaxonTag.categories]
-				conn.execute("INSERT INTO new_tags (taxid, %s) VALUES (%s, %s)" 
-						% (delimiter.join(TaxonTag.categories), row["taxid"], delimiter.join(values)))
+		# ttag is an instance of TaxonTag
+		ttag = tagsDict.pop(key)
+		validTagsDict[key] = ttag
+		# tagsDict does not contain empty tag values so must specify every
+		# category column for each row inserted
+		newTags.append([taxids[0]] + [ttag.tagDict.get(cat, "") for cat in TaxonTag.categories])
+	return validTagsDict, newTags
+
+
+def insertTagsSQL(table):
+	return "INSERT INTO %s (taxid, %s) VALUES (?, %s)" % (table, ', '.join(TaxonTag.categories), ', '.join(['?'] * len(TaxonTag.categories)))
+
+
+def tagHash(values):
+	return hashlib.md5('\0'.join([value or "" for value in values])).hexdigest()
+
+
+# All (name, rank) keys are resolved by a single join through a temporary
+# table; more than one taxid for a key identifies an ambiguous name. Each key
+# is carried through the join by its position, since sqlite returns unicode
+# for the byte strings read from the tag file, which differ for non-ASCII names.
+def resolveTaxids(conn, keys):
+	"""Return {(name, rank): [taxid,...]} for the keys naming at least one taxon."""
+	keys = list(keys)
+	conn.execute("CREATE TEMP TABLE tag_keys (id INTEGER PRIMARY KEY, name TEXT, rank TEXT)")
+	conn.executemany("INSERT INTO tag_keys (id, name, rank) VALUES (?, ?, ?)",
+			[(i, name.decode('utf-8', 'replace'), rank) for i, (name, rank) in enumerate(keys)])
+	rows = conn.execute("""SELECT tag_keys.id, GROUP_CONCAT(names.taxid)
+			FROM tag_keys
+			JOIN names ON names.name = tag_keys.name
+			JOIN nodes ON nodes.taxid = names.taxid AND nodes.rank = tag_keys.rank
+			GROUP BY tag_keys.id""")
+	resolved = dict((keys[i], sorted([int(taxid) for taxid in taxids.split(',')])) for i, taxids in rows.fetchall())
+	conn.execute("DROP TABLE tag_keys")
+	return resolved
+
+
+# TaxonomyParents holds the parent of every taxid in an array indexed by taxid,
+# about 12 MB for the NCBI taxonomy, so ancestry at any rank, e.g., subfamily
+# or order, is decided by walking up the array instead of by the family,
+# genus and species columns of a tagging row.
+class TaxonomyParents(object):
+	"""In-memory parent array read from the nodes table of a taxonomy database."""
+
+	def __init__(self, taxDatabase):
+		print "%sloading taxonomy tree from %s" % (logHeader(), taxDatabase)
+		with sqlite3.connect(taxDatabase) as conn:
+			maxTaxid = conn.execute("SELECT MAX(taxid) FROM nodes").fetchone()[0] or 0
+			# 0 marks a taxid not in nodes; the root is its own parent
+			self.parents = array.array('i', [0]) * (maxTaxid + 1)
+			for taxid, parent in conn.execute("SELECT taxid, parent_taxid FROM nodes"):
+				self.parents[taxid] = parent
+
+	def ancestors(self, taxid):
+		"""Yield the ancestors of taxid, nearest first."""
+		parents = self.parents
+		if not 0 < taxid < len(parents):
+			return
+		parent = parents[taxid]
+		while parent and parent != taxid:
+			yield parent
+			taxid = parent
+			parent = parents[taxid] if taxid < len(parents) else 0
 
-	return validTagsDict
+	def isAncestor(self, ancestor, taxid):
+		for parent in self.ancestors(taxid):
+			if parent == ancestor:
+				return True
+		return False
 
 
 def renameTagTable(taxDatabase):
 	with sqlite3.connect(taxDatabase) as conn:
 		conn.execute("DROP TABLE IF EXISTS tags")
 		conn.execute("ALTER TABLE new_tags RENAME TO tags")
+		conn.execute("DROP TABLE IF EXISTS tag_hashes")
+		conn.execute("ALTER TABLE new_tag_hashes RENAME TO tag_hashes")
+
+
+# updateTags applies only the differences between tagsDict and the tags table, found by
+# comparing a hash of each row's values with tag_hashes, in one transaction. The journal
+# mode is left as it is: only a database already in WAL mode (see enableWAL) lets
+# pipelines reading it carry on while the tags are committed.
+# effective_tags is rewritten for the subtrees of the changed taxa in the same transaction,
+# so readers never see new tags with stale effective tags. Returns the changed taxids, or
+# None without changes if the tag categories differ from the tags table columns.
+def updateTags(taxDatabase, tagsDict):
+	conn = sqlite3.connect(taxDatabase)
+	# manage the transaction explicitly
+	conn.isolation_level = None
+	began = False
+	try:
+		columns = [row[1] for row in conn.execute("PRAGMA table_info(tags)")]
+		if columns != ['taxid'] + TaxonTag.categories:
+			print "%stag categories %s differ from tags table columns %s" % (logHeader(), ', '.join(TaxonTag.categories), ', '.join(columns[1:]))
+			return None
+
+		if conn.execute("PRAGMA journal_mode").fetchone()[0].lower() != 'wal':
+			print "%s%s is not in WAL mode: readers are blocked while the tags are committed" % (logHeader(), taxDatabase)
+		conn.execute("CREATE TABLE IF NOT EXISTS tag_hashes (taxid INTEGER PRIMARY KEY, hash TEXT)")
+		conn.execute("BEGIN IMMEDIATE")
+		began = True
+		validTagsDict, newTags = assignTags(conn, tagsDict)
+
+		# oldHashes = {taxid: hash}; None for rows loaded without a hash
+		oldHashes = dict(conn.execute("SELECT tags.taxid, tag_hashes.hash FROM tags LEFT JOIN tag_hashes ON tag_hashes.taxid = tags.taxid"))
+		inserts = []
+		updates = []
+		hashes = []
+		for row in newTags:
+			taxid = row[0]
+			rowHash = tagHash(row[1:])
+			if taxid not in oldHashes:
+				inserts.append(row)
+			elif oldHashes.pop(taxid) != rowHash:
+				updates.append(row[1:] + [taxid])
+			else:
+				continue
+			hashes.append((taxid, rowHash))
+		# what's left is no longer tagged
+		deletes = [(taxid,) for taxid in oldHashes]
+
+		conn.executemany(insertTagsSQL('tags'), inserts)
+		conn.executemany("UPDATE tags SET %s WHERE taxid = ?" % ', '.join(["%s = ?" % cat for cat in TaxonTag.categories]), updates)
+		conn.executemany("DELETE FROM tags WHERE taxid = ?", deletes)
+		conn.executemany("INSERT OR REPLACE INTO tag_hashes (taxid, hash) VALUES (?, ?)", hashes)
+		conn.executemany("DELETE FROM tag_hashes WHERE taxid = ?", deletes)
+		changed = set([row[0] for row in inserts] + [row[-1] for row in updates] + [row[0] for row in deletes])
+		if changed and hasTable(conn, 'tree'):
+			if hasTable(conn, 'effective_tags'):
+				propagateTags(conn, changed)
+			else:
+				propagateTags(conn)
+		conn.execute("COMMIT")
+		print "%s%d tags inserted, %d updated, %d deleted" % (logHeader(), len(inserts), len(updates), len(deletes))
+		return changed
+	except:
+		if began:
+			conn.execute("ROLLBACK")
+		raise
+	finally:
+		conn.close()
+
+
+# enableWAL switches the taxonomy database to WAL mode, which it keeps, so that later
+# incremental loads do not block readers. Every reader then needs to be able to create
+# the -wal and -shm files beside the database, which a read-only mount, e.g., the
+# singularity /reference bind, does not allow. The switch itself needs the database to
+# be free of readers. Returns whether the database is in WAL mode.
+def enableWAL(taxDatabase):
+	conn = sqlite3.connect(taxDatabase)
+	try:
+		mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+	except sqlite3.OperationalError, e:
+		print "%scannot switch %s to WAL mode (%s): close its readers and retry; loading in the current journal mode" % (logHeader(), taxDatabase, e)
+		return False
+	finally:
+		conn.close()
+	if mode.lower() != 'wal':
+		print "%s%s stays in %s journal mode: WAL is not supported for it" % (logHeader(), taxDatabase, mode)
+		return False
+	print "%s%s is in WAL mode" % (logHeader(), taxDatabase)
+	return True
+
+
+# materializeEffectiveTags pushes each tag down the subtree of its taxon into
+# effective_tags(taxid, category, value, source_taxid), so the tag applying to any
+# taxid is one primary key lookup rather than a walk up its ancestors. Subtrees are
+# ranges of the tree table written by create_taxonomy_db.py. Tags are applied in
+# order of depth, so the tag of the nearest tagged ancestor replaces any above it.
+def materializeEffectiveTags(taxDatabase):
+	with sqlite3.connect(taxDatabase) as conn:
+		if not hasTable(conn, 'tree'):
+			print "%s%s has no tree table: effective_tags not built; rebuild it with create_taxonomy_db.py" % (logHeader(), taxDatabase)
+			return
+		propagateTags(conn)
+
+
+def hasTable(conn, table):
+	return conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+
+# propagateTags rewrites effective_tags for the subtrees of taxids, or for the whole
+# tree if taxids is None, within the caller's transaction. Each subtree is cleared and
+# every tag covering any of it, i.e., of an ancestor, the subtree root or a descendant,
+# is applied again in order of depth, clipped to the subtree.
+def propagateTags(conn, taxids=None):
+	print "%spropagating tags to descendant taxa" % (logHeader(),)
+	conn.execute("""CREATE TABLE IF NOT EXISTS effective_tags (
+			taxid INTEGER,
+			category TEXT,
+			value TEXT,
+			source_taxid INTEGER,
+			PRIMARY KEY (taxid, category)) WITHOUT ROWID""")
+	categories = [row[1] for row in conn.execute("PRAGMA table_info(tags)")][1:]
+	rows = conn.execute("SELECT tags.*, tree.pre, tree.post FROM tags JOIN tree ON tree.taxid = tags.taxid ORDER BY tree.depth").fetchall()
+	if taxids is None:
+		conn.execute("DELETE FROM effective_tags")
+		ranges = [(0, conn.execute("SELECT MAX(post) + 1 FROM tree").fetchone()[0] or 0)]
+	else:
+		ranges = subtreeRanges(conn, taxids)
+
+	for start, end in ranges:
+		if taxids is not None:
+			conn.execute("DELETE FROM effective_tags WHERE taxid IN (SELECT taxid FROM tree WHERE pre >= ? AND pre < ?)", (start, end))
+		for row in rows:
+			taxid, values, pre, post = row[0], row[1:-2], row[-2], row[-1]
+			# nested intervals either contain one another or are disjoint
+			if post <= start or pre >= end:
+				continue
+			for category, value in zip(categories, values):
+				if not value:
+					continue
+				conn.execute("INSERT OR REPLACE INTO effective_tags (taxid, category, value, source_taxid) SELECT taxid, ?, ?, ? FROM tree WHERE pre >= ? AND pre < ?",
+						(category, value, taxid, max(pre, start), min(post, end)))
+
+	if taxids is None:
+		count = conn.execute("SELECT COUNT(*) FROM effective_tags").fetchone()[0]
+		print "%s%d effective tags from %d tagged taxa" % (logHeader(), count, len(rows))
+	else:
+		print "%s%d subtrees of %d changed taxa updated" % (logHeader(), len(ranges), len(taxids))
+
+
+def subtreeRanges(conn, taxids):
+	"""Return the (pre, post) ranges of the subtrees of taxids, less those inside another."""
+	ranges = []
+	for taxid in taxids:
+		row = conn.execute("SELECT pre, post FROM tree WHERE taxid = ?", (taxid,)).fetchone()
+		if row is not None:
+			ranges.append(row)
+	outer = []
+	for pre, post in sorted(ranges):
+		if not outer or pre >= outer[-1][1]:
+			outer.append((pre, post))
+	return outer
 
 
 def logUnappliedTags(tagsDict):
@@ -208,27 +435,99 @@ def logUnappliedTags(tagsDict):
 		print "%sunapplied tags: %s %s: %s" % (logHeader(), rank, name, "; ".join(tags))
 
 
-# searchTaxonomy examines one column in the lookup table (family, genus, or species) using LIKE,
-# i.e., a case-insensitive search. If the '-partial' option is false, then a whole word filter
-# is applied.
+# Searches use a full-text index over the lookup table, lookup_fts, built by
+# create_taxonomy_db.py with the lookup table. It replaces a LIKE '%keyword%'
+# scan of the whole lookup table per keyword: all keywords are combined into
+# one MATCH expression. The index matches whole words or, with '--partial',
+# word prefixes; the regular expressions below then confirm each hit, since
+# the index tokenizer splits words at punctuation that \b does not. Searching
+# never writes to the taxonomy database, so one without the index, e.g., from
+# an older build, is searched with a single LIKE scan for all keywords.
+SEARCH_COLUMNS = ['species', 'genus', 'family', 'lineage']
+
+def searchIndexModule(conn):
+	"""Return the module of lookup_fts, fts5 or fts4, or None if there is no index."""
+	row = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'lookup_fts'").fetchone()
+	if row is None:
+		return None
+	return 'fts5' if 'fts5' in row[0].lower() else 'fts4'
+
+def createSearchIndex(conn):
+	"""Build lookup_fts from the lookup table, replacing any existing index, and return its module."""
+	if searchIndexModule(conn) is not None:
+		# external content is not updated with lookup, so a stale index is dropped
+		conn.execute("DROP TABLE lookup_fts")
+
+	print "%sbuilding full-text search index" % (logHeader(),)
+	columns = ', '.join(SEARCH_COLUMNS)
+	try:
+		conn.execute("CREATE VIRTUAL TABLE lookup_fts USING fts5(%s, content='lookup', content_rowid='taxid', tokenize=\"unicode61 tokenchars '_'\")" % columns)
+		module = 'fts5'
+	except sqlite3.OperationalError:
+		# SQLite older than 3.9 or built without FTS5
+		conn.execute("CREATE VIRTUAL TABLE lookup_fts USING fts4(content='lookup', %s)" % columns)
+		module = 'fts4'
+	conn.execute("INSERT INTO lookup_fts (lookup_fts) VALUES ('rebuild')")
+	conn.commit()
+	return module
+
+
+def matchExpression(module, keywords):
+	phrases = []
+	for keyword in keywords:
+		phrase = keyword.replace('"', '""')
+		if not partial:
+			phrase = '"%s"' % phrase
+		elif module == 'fts5':
+			phrase = '"%s" *' % phrase
+		else:
+			phrase = '"%s*"' % phrase
+		phrases.append(phrase)
+	return ' OR '.join(phrases)
+
+
+def keywordPatterns(keywords):
+	# conservative default requires whole words; partial requires a word prefix
+	if partial:
+		return [(keyword, re.compile(r'\b%s' % re.escape(keyword), re.I)) for keyword in keywords]
+	return [(keyword, re.compile(r'\b%s\b' % re.escape(keyword), re.I)) for keyword in keywords]
+
+
+def searchIndex(conn, column, keywords, columns, orderBy=None):
+	module = searchIndexModule(conn)
+	if module is None:
+		print "%sno full-text search index: scanning lookup; rebuild the database with create_taxonomy_db.py to add one" % (logHeader(),)
+		keywords = list(keywords)
+		sql = "SELECT %s FROM lookup WHERE %s" % (columns, ' OR '.join(["%s LIKE ?" % column] * len(keywords)))
+		params = ["%%%s%%" % keyword for keyword in keywords]
+	else:
+		# a column on the left of MATCH restricts the search to that column
+		sql = "SELECT %s FROM lookup WHERE taxid IN (SELECT rowid FROM lookup_fts WHERE %s MATCH ?)" % (columns, column)
+		params = [matchExpression(module, keywords)]
+	if orderBy:
+		sql += " ORDER BY %s" % orderBy
+	return conn.execute(sql, params)
+
+
+# searchTaxonomy examines one column in the lookup table (family, genus, or species) using
+# the full-text index, i.e., a case-insensitive search of whole words, or of word prefixes
+# if the '-partial' option is true.
 def searchTaxonomy(taxDatabase, tagCat, tagValue, searchRank, keywords):
 	# tagsDict = {(name, rank): TaxonTag object}
 	tagsDict = {}
-	
+	patterns = keywordPatterns(keywords)
+
 	with sqlite3.connect(taxDatabase) as conn:
 		conn.row_factory = sqlite3.Row
-		for keyword in keywords:
-			# conservative default requires whole words, which we determine via regexp
-			reWord = re.compile(r'\b%s\b' % keyword, re.I)
-
-			# SQL statement will return partial word matches
-			for row in conn.execute("SELECT species, genus, family FROM lookup WHERE %s LIKE ?" % searchRank, ("%%%s%%" % keyword,)):
-				if not partial and reWord.search(row[searchRank]) is None:
-					print "%s%s not a whole word in %s" % (logHeader(), keyword, row[searchRank])
-					continue
+		for row in searchIndex(conn, searchRank, keywords, "species, genus, family"):
+			found = [keyword for keyword, reWord in patterns if reWord.search(row[searchRank])]
+			if not found:
+				print "%s%s not a whole word in %s" % (logHeader(), ', '.join(keywords), row[searchRank])
+				continue
 
+			for keyword in found:
 				print "%s%s found %s" % (logHeader(), keyword, row[searchRank])
-				tagsDict[(row[searchRank], searchRank)] = TaxonTag((row["family"], row["genus"], row["species"]), {tagCat: tagValue})
+			tagsDict[(row[searchRank], searchRank)] = TaxonTag((row["family"], row["genus"], row["species"]), {tagCat: tagValue})
 
 	if tagsDict:
 		TaxonTag.setRanks(RANKS)
@@ -245,25 +544,23 @@ def searchTaxonomy(taxDatabase, tagCat, tagValue, searchRank, keywords):
 def searchLineage(taxDatabase, tagCat, tagValue, keywords):
 	# tagsDict = {(name, rank): TaxonTag object}
 	tagsDict = {}
-	
+	patterns = keywordPatterns(keywords)
+
 	with sqlite3.connect(taxDatabase) as conn:
 		conn.row_factory = sqlite3.Row
-		for keyword in keywords:
-			# conservative default requires whole words, which we determine via regexp
-			reWord = re.compile(r'\b%s\b' % keyword, re.I)
-
-			# SQL statement will return partial word matches
-			for row in conn.execute("SELECT rank, family, genus, species, lineage FROM lookup WHERE lineage LIKE ? ORDER BY family, genus, species", ("%%%s%%" % keyword,)):
+		for row in searchIndex(conn, "lineage", keywords, "rank, family, genus, species, lineage", "family, genus, species"):
+			found = [(keyword, reWord) for keyword, reWord in patterns if reWord.search(row["lineage"])]
+			if not found:
+				print "%s%s not a whole word in %s" % (logHeader(), ', '.join(keywords), row["lineage"])
+				continue
 
-				if not partial and reWord.search(row["lineage"]) is None:
-					print "%s%s not a whole word in %s" % (logHeader(), keyword, row["lineage"])
-					continue
+			for keyword, reWord in found:
 				print "%s%s found %s" % (logHeader(), keyword, row["lineage"])
 
 				foundTaxon = False
 				for taxon in row["lineage"].split(';'):
 					if not foundTaxon:
-						if keyword not in taxon or (not partial and reWord.search(taxon) is None):
+						if keyword not in taxon or reWord.search(taxon) is None:
 							continue
 					foundTaxon = True
 
@@ -300,6 +597,48 @@ def searchLineage(taxDatabase, tagCat, tagValue, keywords):
 	return tagsDict
 
 
+# searchLineageTree is searchLineage deciding redundancy by true ancestry: every family,
+# genus, or species whose lineage matches is a candidate, and candidates under another
+# candidate at any rank are dropped.
+def searchLineageTree(taxDatabase, tagCat, tagValue, keywords):
+	# tagsDict = {(name, rank): TaxonTag object}
+	tagsDict = {}
+	patterns = keywordPatterns(keywords)
+	parents = TaxonomyParents(taxDatabase)
+
+	# candidates = {taxid: ((name, rank), TaxonTag object)}
+	candidates = {}
+	with sqlite3.connect(taxDatabase) as conn:
+		conn.row_factory = sqlite3.Row
+		for row in searchIndex(conn, "lineage", keywords, "taxid, rank, family, genus, species, lineage"):
+			found = [keyword for keyword, reWord in patterns if reWord.search(row["lineage"])]
+			if not found:
+				print "%s%s not a whole word in %s" % (logHeader(), ', '.join(keywords), row["lineage"])
+				continue
+			for keyword in found:
+				print "%s%s found %s" % (logHeader(), keyword, row["lineage"])
+
+			rank = str(row["rank"])
+			if rank not in RANKS:
+				continue
+			# taxa below the rank of the row are left blank
+			taxa = tuple([row[r] if RANKS.index(r) <= RANKS.index(rank) else "" for r in RANKS])
+			candidates[row["taxid"]] = ((row[rank], rank), TaxonTag(taxa, {tagCat: tagValue}))
+
+	for taxid, (key, ttag) in candidates.iteritems():
+		for ancestor in parents.ancestors(taxid):
+			if ancestor in candidates:
+				# this lineage is already captured higher up
+				break
+		else:
+			tagsDict[key] = ttag
+
+	if tagsDict:
+		TaxonTag.setRanks(RANKS)
+		TaxonTag.setCategories([tagCat])
+	return tagsDict
+
+
 # collate updates t1 with the contents of t2 and returns a new dictionary, i.e., we always
 # return full contents of t1.
 # t2 is a search result and always contains a single tag category
@@ -349,17 +688,54 @@ def writeTags(tagFile, tagsDict, outFile):
 			print >> f, "%s\t%s" % ('\t'.join(tt.taxa), '\t'.join([tt.tagDict.get(cat, "") for cat in TaxonTag.categories]))
 
 
+# columnAncestorKey returns the key of the first non-blank higher rank in the row
+# that is itself tagged, or None.
+def columnAncestorKey(tagsDict, key, tt):
+	name, rank = key
+	# traverse from species up the tree
+	start = False
+	for i in range(len(tt.ranks)-1, -1, -1):
+		# tt.ranks are currently 'family', 'genus', 'species'
+		# so we are iterating species, genus, family
+		r = tt.ranks[i]
+		if not start and r == rank:
+			start = True
+			continue
+
+		# make key from current taxa column
+		k = (tt.taxa[i], r)
+		if k in tagsDict:
+			return k
+		# higher one might still exist
+	return None
+
+
+# treeAncestorKey returns the key of the nearest tagged ancestor of taxid at any rank, or None.
+def treeAncestorKey(parents, taxidKeys, taxid):
+	for ancestor in parents.ancestors(taxid):
+		if ancestor in taxidKeys:
+			return taxidKeys[ancestor]
+	return None
+
+
 #
 ### Commands
 #
 
 ### Clean command removes redundant rows from a tagging file.
-def clean(tagFile):
+def clean(tagFile, taxDatabase=None):
 	# tagsDict = {(name, rank): TaxonTag()}
 	print "%sbegin cleaning tag file %s" % (logHeader(), tagFile)
 
 	tagsDict = readTagFile(tagFile)
 	count = len(tagsDict)
+	if useTree:
+		parents = TaxonomyParents(taxDatabase)
+		with sqlite3.connect(taxDatabase) as conn:
+			resolved = resolveTaxids(conn, tagsDict.keys())
+		# taxidKeys = {taxid: (name, rank)} for the unambiguous tagging rows
+		taxidKeys = dict((taxids[0], key) for key, taxids in resolved.iteritems() if len(taxids) == 1)
+
 	cleanDict = {}
 	for key in tagsDict:
 		# key comes from most specific taxa in a row
@@ -367,34 +743,18 @@ def clean(tagFile):
 		# tt represents one row in a tagging file
 		tt = tagsDict[key]
 
-		# only first non-blank higher rank is capable of eliminating this row
-		# traverse from species up the tree
-		start = False
-		drop = False
-		for i in range(len(tt.ranks)-1, -1, -1):
-			# tt.ranks are currently 'family', 'genus', 'species'
-			# so we are iterating species, genus, family
-			r = tt.ranks[i]
-			if not start and r == rank:
-				start = True
-				continue
-
-			# make key from current taxa column
-			n = tt.taxa[i]
-			k = (n, r)
-			if k not in tagsDict:
-				# higher one might still exist
-				continue
-
-			# drop this row only if tags are identical
-			if tagsDict[k].tagDict == tt.tagDict:
-				# this entry renders the old one superfluous so we won't include it
-				print "%s%s %s entry supersedes %s %s; dropping %s" % (logHeader(), r, n, rank, name, rank)
-				drop = True
-			
-			break
+		# only the nearest tagged ancestor is capable of eliminating this row
+		if useTree and len(resolved.get(key, [])) == 1:
+			k = treeAncestorKey(parents, taxidKeys, resolved[key][0])
+		else:
+			k = columnAncestorKey(tagsDict, key, tt)
 
-		if not drop:
+		# drop this row only if tags are identical
+		if k is not None and tagsDict[k].tagDict == tt.tagDict:
+			# this entry renders the old one superfluous so we won't include it
+			n, r = k
+			print "%s%s %s entry supersedes %s %s; dropping %s" % (logHeader(), r, n, rank, name, rank)
+		else:
 			cleanDict[key] = tt
 
 	removed = count - len(cleanDict)
@@ -412,12 +772,21 @@ def load(tagFile, taxDatabase):
 	print "%sbegin tagging taxonomy database %s" % (logHeader(), taxDatabase)
 	print "%sreading tag file %s" % (logHeader(), tagFile)
 	tagsDict = readTagFile(tagFile)
+	if wal:
+		enableWAL(taxDatabase)
 
 	print "%sassigning tags" % (logHeader(),)
-	createNewTagTable(taxDatabase)
-	#populateTagsUsingPython(taxDatabase, tagsDict)
-	populateTagsUsingSQL(taxDatabase, tagsDict)
-	renameTagTable(taxDatabase)
+	changed = None
+	if incremental:
+		changed = updateTags(taxDatabase, tagsDict)
+		if changed is None:
+			print "%sreloading all tags" % (logHeader(),)
+	if changed is None:
+		createNewTagTable(taxDatabase)
+		#populateTagsUsingPython(taxDatabase, tagsDict)
+		populateTagsUsingSQL(taxDatabase, tagsDict)
+		renameTagTable(taxDatabase)
+		materializeEffectiveTags(taxDatabase)
 	if tagsDict:
 		print "%snot all tags were assigned" % (logHeader(),)
 		logUnappliedTags(tagsDict)
@@ -431,7 +800,9 @@ def search(tagFile, taxDatabase, tagCat, tagValue, searchRank, keywords):
 	if tagFile:
 		oldTagsDict = readTagFile(tagFile)
 
-	if searchRank == 'lineage':
+	if searchRank == 'lineage' and useTree:
+		tagsDict = searchLineageTree(taxDatabase, tagCat, tagValue, keywords)
+	elif searchRank == 'lineage':
 		tagsDict = searchLineage(taxDatabase, tagCat, tagValue, keywords)
 	else:
 		tagsDict = searchTaxonomy(taxDatabase, tagCat, tagValue, searchRank, keywords)
@@ -464,6 +835,8 @@ def validate(tagFile, taxDatabase):
 	print "%sreading tag file %s" % (logHeader(), tagFile)
 	tagsDict = readTagFile(tagFile)
 	validTagsDict = populateTagsUsingSQL(taxDatabase, tagsDict)
+	if useTree:
+		checkLineages(taxDatabase, validTagsDict)
 	if tagsDict:
 		print "%snot all tags were assignable" % (logHeader(),)
 		logUnappliedTags(tagsDict)
@@ -475,6 +848,30 @@ def validate(tagFile, taxDatabase):
 	print "%svalidation complete" % (logHeader(),)
 
 
+# checkLineages warns about tagging rows whose higher rank columns, e.g., family and
+# genus, are not ancestors of the tagged taxon.
+def checkLineages(taxDatabase, tagsDict):
+	parents = TaxonomyParents(taxDatabase)
+	columnKeys = set()
+	for tt in tagsDict.values():
+		columnKeys.update([(n, r) for n, r in zip(tt.taxa, tt.ranks) if n])
+	with sqlite3.connect(taxDatabase) as conn:
+		resolved = resolveTaxids(conn, columnKeys)
+
+	mismatches = 0
+	for key, tt in sorted(tagsDict.iteritems()):
+		name, rank = key
+		taxid = resolved[key][0]
+		for n, r in zip(tt.taxa, tt.ranks):
+			if not n or (n, r) == key or (n, r) not in resolved:
+				continue
+			if not [t for t in resolved[(n, r)] if parents.isAncestor(t, taxid)]:
+				print "%s%s %s is not under %s %s in the taxonomy" % (logHeader(), rank, name, r, n)
+				mismatches += 1
+	if mismatches:
+		print "%s%d lineage mismatches" % (logHeader(), mismatches)
+
+
 def checkFile(fileName, fileDesc):
 	if fileName is None:
 		usage("%s not specified" % (fileDesc,))
@@ -491,7 +888,7 @@ def check(value, desc):
 
 
 def usage(msg=None):
-	print "Usage: %s <validate|clean|search|load> [--partial] [--taxdb=<taxonomy database file>] [--tagfile=<file path>] [--tagcat=<tag category>] [--tagvalue=<tag value>] [--rank=<search rank>] [[--keyword=<keyword>]...]" % sys.argv[0]
+	print "Usage: %s <validate|clean|search|load> [--partial] [--tree] [--incremental] [--wal] [--taxdb=<taxonomy database file>] [--tagfile=<file path>] [--tagcat=<tag category>] [--tagvalue=<tag value>] [--rank=<search rank>] [[--keyword=<keyword>]...]" % sys.argv[0]
 	print
 	print "  Commands:"
 	print "  	clean: remove logically redundant rows from a tagging file, e.g., species tags under a genus tag"
@@ -500,13 +897,18 @@ def usage(msg=None):
 	print "  		requires tagfile, taxdb; taxonomy database not modified"
 	print "  	search: search a taxonomy database for nodes containing keywords: taxonomy database not modified"
 	print "  		requires taxdb, tagcat, tagvalue, rank, one or more keywords; tagfile is optional"
-	print "  	load: load a tags database table from a tagging file"
+	print "  	load: load a tags database table from a tagging file, and effective_tags with each tag applied to every descendant taxon"
 	print "  		requires tagfile, taxdb"
 	print
 	print "  Options:"
 	print "  	--outdir: destination of new search output file"
-	print "  	--partial: extend search to partial words (default searches whole words only)"
+	print "  	--partial: extend search to words beginning with a keyword (default searches whole words only)"
 	print "  	--dropinvalid: create new file without invalid rows (default leaves file unchanged)"
+	print "  	--tree: decide redundancy (clean, lineage search) by ancestry at any rank and check"
+	print "  		lineages (validate) using the taxonomy tree; clean then requires taxdb"
+	print "  	--incremental: load only the tags that changed since the last load"
+	print "  	--wal: switch the taxonomy database to WAL mode, which it keeps, so loads do not block readers;"
+	print "  		readers then need write access to the database directory"
 	print "  	--taxdb: path to reference taxonomy database file"
 	print "  	--tagfile: tag file to validate or to add tags"
 	print "  	--tagcat: tag category, e.g., host"
@@ -531,6 +933,9 @@ if __name__ == '__main__':
 	outDir = ""
 	partial = False
 	dropInvalid = False
+	useTree = False
+	incremental = False
+	wal = False
 	taxDatabase = tagFile = tagCat = tagValue = None
 	searchRank = None
 	searchRanks = set(['species', 'genus', 'family', 'lineage'])
@@ -547,7 +952,7 @@ if __name__ == '__main__':
 		sys.exit(2)
 
 	try:
-		options, args = getopt.getopt(sys.argv[2:], "", ["outdir=", "partial", "dropinvalid", "taxdb=", "tagfile=", "tagcat=", "tagvalue=", "rank=", "keyword="])
+		options, args = getopt.getopt(sys.argv[2:], "", ["outdir=", "partial", "dropinvalid", "tree", "incremental", "wal", "taxdb=", "tagfile=", "tagcat=", "tagvalue=", "rank=", "keyword="])
 		for option, value in options:
 			if option == '--outdir':
 				outDir = value
@@ -556,6 +961,12 @@ if __name__ == '__main__':
 				partial = True
 			elif option == '--dropinvalid':
 				dropInvalid = True
+			elif option == '--tree':
+				useTree = True
+			elif option == '--incremental':
+				incremental = True
+			elif option == '--wal':
+				wal = True
 			elif option == '--taxdb':
 				taxDatabase = value
 				checkFile(taxDatabase, 'taxonomy database file')
@@ -579,7 +990,9 @@ if __name__ == '__main__':
 
 	if cmd == 'clean':
 		checkFile(tagFile, 'tag file')
-		clean(tagFile)
+		if useTree:
+			checkFile(taxDatabase, 'taxonomy database file')
+		clean(tagFile, taxDatabase)
 
 	elif cmd == 'load':
 		checkFile(tagFile, 'tag file')
@@ -129,6 +129,17 @@ my $row;
 my $begintime = [gettimeofday()];
 my $numeric_lineage ="";
 
+# names_nodes_scientific.db built by create_taxonomy_db.py carries a lookup table
+# with the lineage and canonical rank columns precomputed, so a taxid can be
+# annotated with a single query instead of two queries per ancestor.
+my @lookup_ranks = qw(species genus family order class phylum kingdom superkingdom);
+my %is_lookup_rank = map { $_ => 1 } @lookup_ranks;
+my $use_lookup = 0;
+if (!grep { !$is_lookup_rank{$_} } keys %rank_to_print) {
+	my $columns = $names_nodes_db->selectall_arrayref("PRAGMA table_info(lookup)");
+	$use_lookup = grep { $_->[1] eq "taxid_lineage" } @$columns;
+}
+
 $gi = $ARGV[0];
 $lineage = "";
 chomp $gi;
@@ -141,26 +152,42 @@ print "$gi\t";
 
 if ($taxid) {
 	print "$taxid\t" if ($opt_x);
-	while ($taxid > 1) {
-		# Obtain the scientific name corresponding to a taxid
-		my $name_return = $names_nodes_db->selectrow_arrayref("SELECT name FROM names WHERE taxid = $taxid LIMIT 1");
-		# Obtain the parent taxa taxid
-		# nodes table: taxid - parent_tax id - rank
-		$sth = $names_nodes_db->prepare("SELECT * FROM nodes WHERE taxid = $taxid LIMIT 1");
-		$sth->execute();
-		$row = $sth->fetchrow_arrayref();
-		(my $tid, my $parent, my $rank) = @$row;
-		if ($name_return){
-			$name = trim($name_return->[0]);
+	# a taxid missing from lookup, e.g., one not connected to root, is walked
+	my $lookup_row;
+	$lookup_row = $names_nodes_db->selectrow_hashref("SELECT * FROM lookup WHERE taxid = $taxid") if ($use_lookup);
+	if ($lookup_row) {
+		# print ranks from the taxon up, as the walk below does
+		foreach my $rank (@lookup_ranks) {
+			if (exists($rank_to_print{$rank}) && defined($lookup_row->{$rank}) && $lookup_row->{$rank} ne "") {
+				print "$rank--$lookup_row->{$rank}\t";
+			}
 		}
-		# print the rank if specified on the command line
-		if (exists($rank_to_print{$rank})) {
-			print "$rank--$name\t";
+		$lineage = $lookup_row->{lineage};
+		my @tids = grep { $_ ne "" } split(/;/, $lookup_row->{taxid_lineage});
+		$numeric_lineage = join("", map { "$_ " } @tids) . (" " x scalar(@tids));
+	}
+	else {
+		while ($taxid > 1) {
+			# Obtain the scientific name corresponding to a taxid
+			my $name_return = $names_nodes_db->selectrow_arrayref("SELECT name FROM names WHERE taxid = $taxid LIMIT 1");
+			# Obtain the parent taxa taxid
+			# nodes table: taxid - parent_tax id - rank
+			$sth = $names_nodes_db->prepare("SELECT * FROM nodes WHERE taxid = $taxid LIMIT 1");
+			$sth->execute();
+			$row = $sth->fetchrow_arrayref();
+			(my $tid, my $parent, my $rank) = @$row;
+			if ($name_return){
+				$name = trim($name_return->[0]);
+			}
+			# print the rank if specified on the command line
+			if (exists($rank_to_print{$rank})) {
+				print "$rank--$name\t";
+			}
+			# Build the taxonomy path
+			$lineage = "$name;$lineage";
+			$numeric_lineage = "$tid "."$numeric_lineage ";
+			$taxid="$parent";
 		}
-		# Build the taxonomy path
-		$lineage = "$name;$lineage";
-		$numeric_lineage = "$tid "."$numeric_lineage ";
-		$taxid="$parent";
 	}
 }
 print "lineage--$lineage" if $opt_l;
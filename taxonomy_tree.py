@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+#
+#	taxonomy_tree.py
+#
+#	Subtree queries against the nested interval numbering stored in the
+#	tree table of names_nodes_scientific.db by create_taxonomy_db.py.
+#	Chiu Laboratory
+#	University of California, San Francisco
+#
+# Each taxid has a pre and post number from one depth first traversal, so
+# all descendants of a taxid are a single range scan on pre and
+# "is X under Y" is a comparison of two intervals.
+#
+
+import os
+import sqlite3
+import sys
+
+NAMES_NODES_DB = 'names_nodes_scientific.db'
+
+def logHeader():
+	import os.path, sys, time
+	return "%s\t%s\t" % (time.strftime("%a %b %d %H:%M:%S %Z %Y"), os.path.basename(sys.argv[0]))
+
+
+class SubtreeIndex(object):
+	"""Descendant and ancestry queries for a taxonomy database."""
+
+	def __init__(self, taxDatabase):
+		self.conn = sqlite3.connect(taxDatabase)
+		row = self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'tree'").fetchone()
+		if row is None:
+			raise ValueError("%s has no tree table: rebuild it with create_taxonomy_db.py" % taxDatabase)
+		# intervals = {taxid: (pre, post)}, filled on demand
+		self.intervals = {}
+
+	def interval(self, taxid):
+		"""Return (pre, post) for a taxid, or None if it is not in the tree."""
+		taxid = int(taxid)
+		interval = self.intervals.get(taxid)
+		if interval is None:
+			row = self.conn.execute("SELECT pre, post FROM tree WHERE taxid = ?", (taxid,)).fetchone()
+			if row is None:
+				return None
+			interval = self.intervals[taxid] = (row[0], row[1])
+		return interval
+
+	def loadIntervals(self):
+		"""Read every interval into memory so isUnder() needs no queries."""
+		self.intervals = dict((row[0], (row[1], row[2])) for row in self.conn.execute("SELECT taxid, pre, post FROM tree"))
+
+	def descendants(self, taxid, includeSelf=False):
+		"""Yield every taxid below taxid, in depth first order."""
+		interval = self.interval(taxid)
+		if interval is None:
+			return
+		pre, post = interval
+		if includeSelf:
+			sql = "SELECT taxid FROM tree WHERE pre >= ? AND pre < ? ORDER BY pre"
+		else:
+			sql = "SELECT taxid FROM tree WHERE pre > ? AND pre < ? ORDER BY pre"
+		for row in self.conn.execute(sql, (pre, post)):
+			yield row[0]
+
+	def isUnder(self, taxid, ancestor):
+		"""Return True if taxid is a descendant of ancestor."""
+		child = self.interval(taxid)
+		parent = self.interval(ancestor)
+		if child is None or parent is None:
+			return False
+		return parent[0] < child[0] and child[1] < parent[1]
+
+	def close(self):
+		self.conn.close()
+
+
+#
+### Command line
+#
+
+def usage(msg=None):
+	print "Usage: %s <descendants|isunder> [--taxdb=<taxonomy database file>] [-q <taxonomy folder>] --taxid=<taxid> [--ancestor=<taxid>] [--self]" % sys.argv[0]
+	print
+	print "  Commands:"
+	print "  	descendants: print all taxids below taxid, one per line"
+	print "  	isunder: print 'yes' and exit 0 if taxid is below ancestor, otherwise print 'no' and exit 1"
+	print
+	print "  Options:"
+	print "  	--taxdb: path to names_nodes_scientific.db"
+	print "  	-q: folder containing %s (used when --taxdb is not given)" % NAMES_NODES_DB
+	print "  	--taxid: taxid to query"
+	print "  	--ancestor: candidate ancestor taxid for isunder"
+	print "  	--self: include taxid itself in descendants"
+	if msg:
+		print msg
+
+
+if __name__ == '__main__':
+	import getopt
+	taxDatabase = taxid = ancestor = None
+	includeSelf = False
+
+	commands = set(['descendants', 'isunder'])
+	try:
+		cmd = sys.argv[1]
+	except IndexError:
+		usage("must specify a command")
+		sys.exit(2)
+	if cmd not in commands:
+		usage("unknown command '%s'" % cmd)
+		sys.exit(2)
+
+	try:
+		options, args = getopt.getopt(sys.argv[2:], "q:t:a:", ["taxdb=", "taxid=", "ancestor=", "self"])
+		for option, value in options:
+			if option == '--taxdb':
+				taxDatabase = value
+			elif option == '-q':
+				taxDatabase = os.path.join(value, NAMES_NODES_DB)
+			elif option in ('-t', '--taxid'):
+				taxid = value
+			elif option in ('-a', '--ancestor'):
+				ancestor = value
+			elif option == '--self':
+				includeSelf = True
+	except getopt.GetoptError, msg:
+		usage(msg)
+		sys.exit(2)
+
+	if taxDatabase is None or not os.path.exists(taxDatabase):
+		usage("taxonomy database file not found: %s" % taxDatabase)
+		sys.exit(2)
+	if taxid is None:
+		usage("taxid not specified")
+		sys.exit(2)
+
+	try:
+		index = SubtreeIndex(taxDatabase)
+	except ValueError, msg:
+		print "%s%s" % (logHeader(), msg)
+		sys.exit(2)
+
+	if cmd == 'descendants':
+		out = sys.stdout
+		for child in index.descendants(taxid, includeSelf):
+			out.write("%d\n" % child)
+
+	elif cmd == 'isunder':
+		if ancestor is None:
+			usage("ancestor not specified")
+			sys.exit(2)
+		if index.isUnder(taxid, ancestor):
+			print "yes"
+		else:
+			print "no"
+			sys.exit(1)
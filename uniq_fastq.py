@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+#
+#	uniq_fastq.py
+#
+#	Collapse a FASTQ file to its unique reads, keeping the first record
+#	with each sequence, in input order.
+#	Chiu Laboratory
+#	University of California, San Francisco
+#
+# preprocess_ncores.sh used to convert the FASTQ to FASTA with sed, run gt
+# sequniq and pull the surviving records back out of the FASTQ with
+# extractHeaderFromFastq.csh. Here each sequence is reduced to a 64-bit
+# digest (xxhash if installed, otherwise the first 8 bytes of MD5) and the
+# digests are checked against an open-addressing hash table held in numpy
+# arrays, a batch of reads at a time, so the FASTQ is streamed once and
+# unique records are written as they are found.
+#
+# The table holds 16 bytes per slot, in a power of two number of slots kept
+# at most half full, and growing it briefly holds the old and new arrays, so
+# it peaks at up to 3 * 16 * nextpow2(2 * reads) bytes. When that would not
+# fit in the memory allowed for the estimated read count, the digests and
+# read numbers are instead spilled to partition files by digest. Each
+# partition is collapsed on its own, and a second pass over the FASTQ writes
+# the records kept by any partition.
+#
+# Reads are compared by digest only. Two different sequences with the same
+# 64-bit digest are taken as duplicates and the later one is dropped; among
+# 500 million distinct reads the chance of any such collision is about 0.7%.
+#
+# Optionally the number of reads collapsed into each kept record, itself
+# included, is written one per line in output order.
+#
+
+import getopt
+import hashlib
+import itertools
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+
+try:
+	import xxhash
+except ImportError:
+	xxhash = None
+
+BUFFER_SIZE = 16 * 1024 * 1024
+BATCH_SIZE = 100000
+# bytes per table slot, held three times over while the table grows, and
+# per read of collapsing one partition
+SLOT_BYTES = 16
+PARTITION_BYTES = 48
+
+if xxhash is not None:
+	def digest(sequence):
+		return xxhash.xxh64(sequence).digest()
+else:
+	def digest(sequence):
+		return hashlib.md5(sequence).digest()[:8]
+
+def readBatches(fastqFile):
+	"""Yield lists of (header, sequence, plus, quality) line tuples."""
+	with open(fastqFile, 'rb', BUFFER_SIZE) as f:
+		records = itertools.izip(f, f, f, f)
+		while True:
+			batch = list(itertools.islice(records, BATCH_SIZE))
+			if not batch:
+				break
+			yield batch
+
+def digests(batch):
+	"""Return the sequence digests of a batch as a uint64 array; 0 is reserved for empty slots."""
+	keys = numpy.frombuffer(''.join([digest(record[1].rstrip('\n')) for record in batch]), dtype='<u8').astype(numpy.uint64)
+	keys[keys == 0] = 1
+	return keys
+
+
+class DigestTable(object):
+	"""Open-addressing set of digests, numbering each in order of first occurrence."""
+
+	def __init__(self, capacity=1 << 20):
+		self.keys = numpy.zeros(capacity, dtype=numpy.uint64)
+		self.ordinals = numpy.zeros(capacity, dtype=numpy.int64)
+		self.mask = numpy.uint64(capacity - 1)
+		self.count = 0
+
+	def grow(self):
+		keys, ordinals = self.keys, self.ordinals
+		occupied = keys != 0
+		self.__init__(len(keys) * 2)
+		slots = self.place(keys[occupied])
+		self.ordinals[slots] = ordinals[occupied]
+		self.count = int(occupied.sum())
+
+	def place(self, keys):
+		"""Store distinct keys not in the table; return their slots."""
+		slots = numpy.empty(len(keys), dtype=numpy.uint64)
+		pending = numpy.arange(len(keys))
+		probe = keys & self.mask
+		while pending.size:
+			s = probe[pending]
+			free = self.keys[s] == 0
+			# of several keys probing the same free slot the first takes it
+			freeSlots, first = numpy.unique(s[free], return_index=True)
+			winners = pending[free][first]
+			self.keys[freeSlots] = keys[winners]
+			slots[winners] = freeSlots
+			placed = numpy.zeros(len(pending), dtype=bool)
+			placed[numpy.flatnonzero(free)[first]] = True
+			# the rest move to the next slot, or retry a slot just taken
+			moving = pending[~free]
+			probe[moving] = (probe[moving] + numpy.uint64(1)) & self.mask
+			pending = pending[~placed]
+		return slots
+
+	def find(self, keys):
+		"""Return the slot of each key, or -1 where the key is not in the table."""
+		slots = numpy.full(len(keys), -1, dtype=numpy.int64)
+		pending = numpy.arange(len(keys))
+		probe = keys & self.mask
+		while pending.size:
+			s = probe[pending]
+			found = self.keys[s]
+			hit = found == keys[pending]
+			slots[pending[hit]] = s[hit]
+			# an empty slot ends the probe sequence
+			moving = ~hit & (found != 0)
+			pending = pending[moving]
+			probe[pending] = (probe[pending] + numpy.uint64(1)) & self.mask
+		return slots
+
+	def add(self, keys):
+		"""Add distinct keys, in order of first occurrence; return each key's ordinal and which are new."""
+		while (self.count + len(keys)) * 2 > len(self.keys):
+			self.grow()
+		slots = self.find(keys)
+		new = slots < 0
+		newSlots = self.place(keys[new])
+		ordinals = numpy.empty(len(keys), dtype=numpy.int64)
+		ordinals[~new] = self.ordinals[slots[~new]]
+		ordinals[new] = numpy.arange(self.count, self.count + len(newSlots))
+		self.ordinals[newSlots] = ordinals[new]
+		self.count += len(newSlots)
+		return ordinals, new
+
+
+class Counts(object):
+	"""Growable array of reads collapsed into each kept record."""
+
+	def __init__(self):
+		self.counts = numpy.zeros(BATCH_SIZE, dtype=numpy.uint32)
+
+	def add(self, ordinals, counts):
+		if ordinals.size and ordinals.max() >= len(self.counts):
+			self.counts = numpy.concatenate([self.counts, numpy.zeros(max(len(self.counts), ordinals.max() + 1), dtype=numpy.uint32)])
+		numpy.add.at(self.counts, ordinals, counts.astype(numpy.uint32))
+
+def writeCounts(countsFile, counts):
+	with open(countsFile, 'wb', BUFFER_SIZE) as out:
+		for count in counts:
+			out.write('%d\n' % count)
+
+
+def uniqInMemory(fastqFile, outputFile, countsFile=None):
+	"""Stream fastqFile once, writing the first record of each sequence; return reads and unique reads."""
+	table = DigestTable()
+	counts = Counts() if countsFile else None
+	reads = 0
+	with open(outputFile, 'wb', BUFFER_SIZE) as out:
+		for batch in readBatches(fastqFile):
+			reads += len(batch)
+			keys, first, batchCounts = numpy.unique(digests(batch), return_index=True, return_counts=True)
+			# number keys in batch order so ordinals follow the output
+			order = numpy.argsort(first)
+			keys, first, batchCounts = keys[order], first[order], batchCounts[order]
+			ordinals, new = table.add(keys)
+			for i in first[new]:
+				out.write(''.join(batch[i]))
+			if counts is not None:
+				counts.add(ordinals, batchCounts)
+	if counts is not None:
+		writeCounts(countsFile, counts.counts[:table.count])
+	return reads, table.count
+
+def uniqPartitioned(fastqFile, outputFile, partitions, countsFile=None):
+	"""Collapse fastqFile through digest partitions spilled to disk; return reads and unique reads."""
+	tmpDir = tempfile.mkdtemp(prefix='uniq_fastq.', dir=os.path.dirname(os.path.abspath(outputFile)))
+	try:
+		# pass 1: spill digests and read numbers by partition
+		partFiles = [(open(os.path.join(tmpDir, '%03d.keys' % p), 'wb', BUFFER_SIZE), open(os.path.join(tmpDir, '%03d.reads' % p), 'wb', BUFFER_SIZE))
+				for p in range(partitions)]
+		reads = 0
+		for batch in readBatches(fastqFile):
+			keys = digests(batch)
+			readNumbers = numpy.arange(reads, reads + len(batch), dtype=numpy.int64)
+			reads += len(batch)
+			parts = keys % numpy.uint64(partitions)
+			for p, (keysFile, readsFile) in enumerate(partFiles):
+				inPart = parts == p
+				keys[inPart].tofile(keysFile)
+				readNumbers[inPart].tofile(readsFile)
+		for keysFile, readsFile in partFiles:
+			keysFile.close()
+			readsFile.close()
+
+		# collapse each partition; reads were spilled in order, so the
+		# first occurrence of a digest is its first read
+		kept = []
+		for p in range(partitions):
+			base = os.path.join(tmpDir, '%03d' % p)
+			keys = numpy.fromfile(base + '.keys', dtype=numpy.uint64)
+			readNumbers = numpy.fromfile(base + '.reads', dtype=numpy.int64)
+			os.remove(base + '.keys')
+			os.remove(base + '.reads')
+			keys, first, partCounts = numpy.unique(keys, return_index=True, return_counts=True)
+			order = numpy.argsort(first)
+			numpy.save(base + '.kept.npy', readNumbers[first[order]])
+			numpy.save(base + '.counts.npy', partCounts[order].astype(numpy.uint32))
+			del keys, readNumbers, first, partCounts, order
+			kept.append((numpy.load(base + '.kept.npy', mmap_mode='r'), numpy.load(base + '.counts.npy', mmap_mode='r')))
+
+		# pass 2: write the kept records, merging the partitions a batch at a time
+		unique = 0
+		cursors = [0] * partitions
+		countsOut = open(countsFile, 'wb', BUFFER_SIZE) if countsFile else None
+		with open(outputFile, 'wb', BUFFER_SIZE) as out:
+			start = 0
+			for batch in readBatches(fastqFile):
+				end = start + len(batch)
+				batchKept = []
+				batchCounts = []
+				for p, (keptReads, keptCounts) in enumerate(kept):
+					stop = int(numpy.searchsorted(keptReads, end))
+					batchKept.append(keptReads[cursors[p]:stop])
+					batchCounts.append(keptCounts[cursors[p]:stop])
+					cursors[p] = stop
+				batchKept = numpy.concatenate(batchKept)
+				order = numpy.argsort(batchKept)
+				for i in batchKept[order] - start:
+					out.write(''.join(batch[i]))
+				if countsOut is not None:
+					for count in numpy.concatenate(batchCounts)[order]:
+						countsOut.write('%d\n' % count)
+				unique += len(batchKept)
+				start = end
+		if countsOut is not None:
+			countsOut.close()
+		del kept
+		return reads, unique
+	finally:
+		shutil.rmtree(tmpDir, ignore_errors=True)
+
+def estimateReads(fastqFile):
+	"""Estimate the number of reads from the size of the first records."""
+	size = os.path.getsize(fastqFile)
+	with open(fastqFile, 'rb') as f:
+		sample = f.read(1024 * 1024)
+	lines = sample.count('\n')
+	if lines < 4:
+		return 1
+	return int(size / (float(len(sample)) / (lines // 4))) + 1
+
+def tableBytes(reads, counts=False):
+	"""Return the peak memory of a DigestTable, and Counts if counts, holding reads digests."""
+	capacity = 1 << 20
+	while capacity < 2 * reads:
+		capacity *= 2
+	# Counts grows by doubling an array of uint32
+	return 3 * SLOT_BYTES * capacity + (3 * 4 * reads if counts else 0)
+
+def uniq(fastqFile, outputFile, countsFile=None, memory=8.0, partitions=0):
+	"""Collapse fastqFile to unique reads within memory GB, or through partitions if given."""
+	if not partitions:
+		reads = estimateReads(fastqFile)
+		if tableBytes(reads, countsFile is not None) <= memory * 2 ** 30:
+			return uniqInMemory(fastqFile, outputFile, countsFile)
+		partitions = int(math.ceil(reads * PARTITION_BYTES / (memory * 2 ** 30)))
+	if partitions <= 1:
+		return uniqInMemory(fastqFile, outputFile, countsFile)
+	return uniqPartitioned(fastqFile, outputFile, partitions, countsFile)
+
+
+def usage():
+	print "Usage: %s [--counts <counts file>] [--memory <GB>] [--partitions <N>] <input FASTQ> <output FASTQ>" % sys.argv[0]
+	print "  --counts: write the number of reads collapsed into each output record, one per line"
+	print "  --memory: memory to use for the digest table (default: 8 GB)"
+	print "  --partitions: spill digests to N partitions on disk (default: only if the table would not fit in memory)"
+
+if __name__ == '__main__':
+	options, args = getopt.getopt(sys.argv[1:], "", ['counts=', 'memory=', 'partitions='])
+	countsFile = None
+	memory = 8.0
+	partitions = 0
+	for option, value in options:
+		if option == '--counts':
+			countsFile = value
+		elif option == '--memory':
+			memory = float(value)
+		elif option == '--partitions':
+			partitions = int(value)
+
+	if len(args) != 2:
+		usage()
+		sys.exit(2)
+
+	start = time.time()
+	reads, unique = uniq(args[0], args[1], countsFile, memory, partitions)
+	print "# %d of %d reads unique, written to %s in %.1f s (%s)" % (
+			unique, reads, args[1], time.time() - start, 'xxhash' if xxhash is not None else 'md5')